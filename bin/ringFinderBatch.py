@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Batch ring analysis without the GUI. Runs the same analysis as the batch
+buttons of Gollum on the tiff files given, or on all the tiff files of the
+folders given, with the settings of a config file saved by Gollum. Results
+are saved in a results folder inside every folder of images.
+
+usage: python -m bin.ringFinderBatch config images [images ...] [--tile N]
+"""
+
+import os
+import argparse
+import shutil
+
+import ringfinder.tools as tools
+import ringfinder.analysis as analysis
+from ringfinder.resultstore import ResultStore
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Batch ring analysis.')
+    parser.add_argument('config', help='config file saved by Gollum')
+    parser.add_argument('images', nargs='+',
+                        help='tiff files or folders with tiff files')
+    parser.add_argument('--tech', choices=('STED', 'STORM'), default='STED',
+                        help='technique of the images (default: STED)')
+    parser.add_argument('--workers', type=int,
+                        help='worker processes (default: from config)')
+    parser.add_argument('--engine', choices=('batch', 'phasefit', 'loop'),
+                        default='batch',
+                        help='correlation engine, also of the period sweep '
+                        '(default: batch)')
+    parser.add_argument('--profiles', action='store_true',
+                        help='keep the angular profiles of the subregions')
+    parser.add_argument('--no-maps', dest='maps', action='store_false',
+                        help='only save the block results, the images of '
+                        'the results can be saved later with '
+                        'bin.ringFinderMaps')
+    parser.add_argument('--store', metavar='DATABASE',
+                        help='also add the results of every subregion to a '
+                        'results database, see bin.ringFinderQuery')
+    parser.add_argument('--tile', type=int, metavar='BLOCKS',
+                        help='analyze images in tiles of BLOCKS x BLOCKS '
+                        'subregions, for images larger than memory')
+    parser.add_argument('--no-cache', dest='cache', action='store_false',
+                        help='analyze again files with cached results')
+    args = parser.parse_args()
+
+    settings = analysis.loadSettings(args.config, args.tech)
+    settings['engine'] = args.engine
+    settings['profiles'] = args.profiles
+    settings['tileBlocks'] = args.tile
+    workers = settings['workers'] if args.workers is None else args.workers
+    pool = tools.processPool(workers) if workers > 1 else None
+    store = None if args.store is None else ResultStore(args.store)
+
+    try:
+        for filenames in analysis.imageFiles(args.images):
+            blocksName, summary = analysis.batch(filenames, settings, pool,
+                                                 cache=args.cache,
+                                                 maps=args.maps, store=store)
+
+            # save configuration file in the results folder
+            config = os.path.join(os.path.split(blocksName)[0], 'config')
+            if os.path.abspath(args.config) != os.path.abspath(config):
+                shutil.copyfile(args.config, config)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        if store is not None:
+            store.close()
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""
+Correlation, ring and ring period images of a batch analysis, saved from the
+block results of its results folder (the *blocks.npz file), for example
+after running ringFinderBatch with --no-maps or to see the rings of another
+discrimination threshold.
+
+usage: python -m bin.ringFinderMaps blocks [--files file [file ...]]
+       [--corr threshold]
+"""
+
+import argparse
+
+import ringfinder.analysis as analysis
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Images of batch results.')
+    parser.add_argument('blocks', help='blocks.npz file of a batch analysis')
+    parser.add_argument('--files', nargs='+',
+                        help='names of the images (default: all)')
+    parser.add_argument('--corr', type=float,
+                        help='discrimination threshold (default: the one of '
+                        'the analysis)')
+    args = parser.parse_args()
+
+    try:
+        for name in analysis.saveMaps(args.blocks, args.files, args.corr):
+            print(name)
+    except ValueError as error:
+        parser.error(error)
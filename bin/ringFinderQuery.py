@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Ring fraction of every folder of images in a results database written by
+ringFinderBatch --store, for a discrimination threshold, without reading
+the results of every folder, or with --stats all the statistics of batch.
+Results of every analysis settings are listed separately.
+
+usage: python -m bin.ringFinderQuery database --corr threshold
+       [--folder folder] [--params key] [--stats]
+"""
+
+import os
+import argparse
+
+from ringfinder.resultstore import ResultStore
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Results database query.')
+    parser.add_argument('database', help='results database')
+    parser.add_argument('--corr', type=float, required=True,
+                        help='discrimination threshold')
+    parser.add_argument('--folder', help='only the images of this folder')
+    parser.add_argument('--params',
+                        help='only the results of these analysis settings')
+    parser.add_argument('--stats', action='store_true',
+                        help='PSS fraction and mean correlations too')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.database):
+        parser.error('no database ' + args.database)
+    folder = None if args.folder is None else os.path.abspath(args.folder)
+
+    with ResultStore(args.database) as store:
+        if args.params is None:
+            analyses = sorted({f[3] for f in store.files()})
+        else:
+            analyses = [args.params]
+
+        header = ('folder', 'files', 'n', 'nrings', 'ringFrac', 'ringFracStd')
+        names = ('n', 'nrings', 'ringFrac', 'pssFrac', 'pssFracStd',
+                 'meanCorr', 'corrStd', 'meanRingCorr', 'ringCorrStd')
+        for params in analyses:
+            print('settings', params)
+            if not args.stats:
+                print('\t'.join(header))
+                for row in store.ringFractions(args.corr, folder, params):
+                    print('%s\t%i\t%i\t%i\t%f\t%f' % row)
+                continue
+
+            folders, stats = store.stats(args.corr, folder, params)
+            print('\t'.join(('folder', ) + names))
+            for i, name in enumerate(folders):
+                print('\t'.join([name, '%i' % stats['n'][i],
+                                 '%i' % stats['nrings'][i]] +
+                                ['%f' % stats[s][i] for s in names[2:]]))
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Batch statistics for a grid of thresholds, from the block results saved by a
+batch analysis in its results folder (the *blocks.npz file), without
+analyzing the images again. Thresholds are given as min max step, and they
+default to the ones of the analysis.
+
+usage: python -m bin.ringFinderThresholds blocks [--corr min max step]
+       [--nsigmas min max step] [--area min max step] [--output file]
+       [--histograms file] [--deltaTh angle]
+"""
+
+import argparse
+import numpy as np
+
+import ringfinder.tools as tools
+import ringfinder.analysis as analysis
+
+
+def thresholdRange(values, default):
+    if values is None:
+        return np.array([default])
+    start, stop, step = values
+    return np.arange(start, stop + 0.5*step, step)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Threshold sweep.')
+    parser.add_argument('blocks', help='blocks.npz file of a batch analysis')
+    parser.add_argument('--corr', nargs=3, type=float,
+                        help='discrimination thresholds')
+    parser.add_argument('--nsigmas', nargs=3, type=float,
+                        help='intensity thresholds in sigmas from the mean')
+    parser.add_argument('--area', nargs=3, type=float,
+                        help='area thresholds in %%')
+    parser.add_argument('--deltaTh', type=float,
+                        help='angle window of the correlations, only for '
+                        'results with angular profiles')
+    parser.add_argument('--output', help='text file for the results table')
+    parser.add_argument('--histograms',
+                        help='text file for the correlation histograms')
+    args = parser.parse_args()
+
+    with np.load(args.blocks) as blocks:
+        corrThres = thresholdRange(args.corr, blocks['corrThres'])
+        intThres = thresholdRange(args.nsigmas, blocks['intThres'])
+        minArea = thresholdRange(args.area, blocks['minArea'])
+        corr = blocks['corr']
+        if args.deltaTh is not None:
+            # Correlations of the new angle window from the profiles
+            if 'profileOffset' not in blocks:
+                parser.error('the results have no angular profiles')
+            shape = blocks['corrProfile'].shape
+            corr = tools.profileMax(
+                blocks['profileOffset'],
+                blocks['corrProfile'].reshape(-1, shape[-1]),
+                blocks['phaseProfile'].reshape(-1, shape[-1]),
+                blocks['th0'].ravel(), args.deltaTh)[0]
+            corr = corr.reshape(shape[:-1])
+        stats = analysis.thresholdSweep(corr, blocks['maxZ'],
+                                        blocks['neuronFrac'], corrThres,
+                                        intThres, minArea)
+
+    # One row for every combination of thresholds
+    names = ('n', 'nrings', 'pssFrac', 'pssFracStd', 'meanCorr', 'corrStd',
+             'meanRingCorr', 'ringCorrStd')
+    grid = np.meshgrid(intThres, minArea, corrThres, indexing='ij')
+    table = np.stack([g.ravel() for g in grid] +
+                     [stats[name].ravel() for name in names], 1)
+    header = '\t'.join(('nsigmas', 'area', 'corrThres') + names)
+    fmt = ['%g']*3 + ['%i']*2 + ['%f']*6
+
+    if args.output is None:
+        print(header)
+        for row in table:
+            print('\t'.join(f % v for f, v in zip(fmt, row)))
+    else:
+        np.savetxt(args.output, table, fmt=fmt, delimiter='\t',
+                   header=header, comments='')
+
+    # One row for every pair of intensity and area thresholds, with the
+    # counts of every bin of the histogram
+    if args.histograms is not None:
+        grid = np.meshgrid(intThres, minArea, indexing='ij')
+        hist = stats['hist'].reshape(-1, stats['hist'].shape[-1])
+        table = np.hstack([np.stack([g.ravel() for g in grid], 1), hist])
+        edges = ' '.join('%f' % e for e in stats['histEdges'])
+        np.savetxt(args.histograms, table, delimiter='\t',
+                   fmt=['%g']*2 + ['%i']*hist.shape[1],
+                   header='nsigmas\tarea\tcounts of bins with edges ' + edges,
+                   comments='')
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Ring statistics of groups of blocks, files and conditions, computed with
+bincount reductions over flat tables of block results, so that they scale to
+millions of blocks.
+"""
+
+import numpy as np
+
+
+def groupMoments(values, groups, ngroups):
+    """Number, mean and sum of squared deviations from the mean of the
+    values of every group (see analysis.moments). Values are summed by group
+    with bincount, in two passes for the precision of the deviations.
+
+    values: 1D array of values
+    groups: group index of every value, from 0 to ngroups - 1
+
+    returns:
+
+    count, mean, m2: arrays of length ngroups, with mean 0 for empty groups"""
+
+    count = np.bincount(groups, minlength=ngroups)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.bincount(groups, values, ngroups)/count
+    mean[count == 0] = 0
+    m2 = np.bincount(groups, (values - mean[groups])**2, ngroups)
+    return count, mean, m2
+
+
+def sumMoments(count, total, total2):
+    """Number, mean and sum of squared deviations from the mean (see
+    groupMoments) from the number, sum and sum of squares of values, with
+    mean 0 when there are no values."""
+
+    count = np.asarray(count)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.where(count > 0, total/count, 0)
+    m2 = np.maximum(total2 - count*mean**2, 0)
+    return count, mean, m2
+
+
+def binomialStd(frac, n):
+    """Standard deviation of a fraction frac of n samples (binomial)."""
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.sqrt(frac*(1 - frac)/n)
+
+
+def standardError(m2, n):
+    """Standard error of the mean of n values with a sum of squared
+    deviations m2."""
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.sqrt(m2/np.square(n, dtype=float))
+
+
+def fileStats(corr, files, nfiles, corrThres):
+    """Moments of the correlations and of the ring correlations of every
+    file, from the block correlations of all the files.
+
+    corr: 1D array of block correlations, nan for blocks without neurons
+    files: file index of every block, from 0 to nfiles - 1
+    corrThres: discrimination threshold of rings
+
+    returns:
+
+    corrMoments, ringMoments: (count, mean, m2) of every file, see
+    groupMoments"""
+
+    corr = np.asarray(corr, dtype=float)
+    files = np.asarray(files)
+    valid = ~np.isnan(corr)
+    corr, files = corr[valid], files[valid]
+    ring = corr > corrThres
+    return (groupMoments(corr, files, nfiles),
+            groupMoments(corr[ring], files[ring], nfiles))
+
+
+def groupStats(corrMoments, ringMoments, groups, ngroups):
+    """Ring statistics of groups of files, as the ones of batch for a folder,
+    from the moments of the correlations of every file (see fileStats).
+
+    groups: group index of every file, from 0 to ngroups - 1
+
+    returns:
+
+    dict with arrays of length ngroups with the number of blocks with
+    neurons 'n', 'nrings', their 'ringFrac', PSS fraction 'pssFrac' (mean
+    of the ring fractions of the files with blocks) and its binomial
+    'pssFracStd', mean of the mean correlations of the files 'meanCorr' and
+    the standard error of the correlations 'corrStd', and the same for the
+    ring correlations, 'meanRingCorr' and 'ringCorrStd'"""
+
+    groups = np.asarray(groups)
+
+    def pooled(count, mean, m2):
+        # Moments of the blocks of every group from the ones of its files
+        n = np.bincount(groups, count, ngroups)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            groupMean = np.bincount(groups, count*mean, ngroups)/n
+        deviation = np.where(count > 0, mean - groupMean[groups], 0)
+        m2 = np.bincount(groups, m2 + count*deviation**2, ngroups)
+        return n, m2
+
+    def meanOf(values, selected):
+        # Mean of the values of the selected files of every group
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (np.bincount(groups, np.where(selected, values, 0),
+                                ngroups) /
+                    np.bincount(groups, selected, ngroups))
+
+    count, mean, m2 = corrMoments
+    ringCount, ringMean, ringM2 = ringMoments
+    n, m2 = pooled(count, mean, m2)
+    nrings, ringM2 = pooled(ringCount, ringMean, ringM2)
+    withBlocks = count > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ringFrac = nrings/n
+        fileFracs = np.where(withBlocks, ringCount/count, 0)
+
+    return {'n': n.astype(int), 'nrings': nrings.astype(int),
+            'ringFrac': ringFrac, 'pssFrac': meanOf(fileFracs, withBlocks),
+            'pssFracStd': binomialStd(ringFrac, n),
+            'meanCorr': meanOf(mean, withBlocks),
+            'corrStd': standardError(m2, n),
+            'meanRingCorr': meanOf(ringMean, ringCount > 0),
+            'ringCorrStd': standardError(ringM2, nrings)}
+
+
+def blockStats(corr, files, groups, corrThres):
+    """Ring statistics of groups of files (see groupStats) from a flat table
+    of block correlations.
+
+    corr: 1D array of block correlations, nan for blocks without neurons
+    files: file index of every block
+    groups: group index of every file, for example its folder or condition
+
+    returns:
+
+    dict of groupStats, with the statistics of every file in 'files'
+    (groupStats with a group for every file)"""
+
+    groups = np.asarray(groups)
+    nfiles = len(groups)
+    ngroups = int(groups.max()) + 1 if nfiles else 0
+    corrMoments, ringMoments = fileStats(corr, files, nfiles, corrThres)
+    stats = groupStats(corrMoments, ringMoments, groups, ngroups)
+    stats['files'] = groupStats(corrMoments, ringMoments, np.arange(nfiles),
+                                nfiles)
+    return stats
@@ -0,0 +1,1012 @@
+# -*- coding: utf-8 -*-
+"""
+Analysis of whole image files without the GUI, so that it can run in worker
+processes. It follows the same steps as Gollum.
+"""
+
+import io
+import os
+import json
+import time
+import shutil
+import zipfile
+import itertools
+import hashlib
+import numbers
+import configparser
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy import ndimage as ndi
+import tifffile as tiff
+import matplotlib.style
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+import ringfinder.utils as utils
+import ringfinder.aggregate as aggregate
+import ringfinder.tools as tools
+
+
+# Settings that change the results of an image, and version of the results,
+# to be changed when analyzeFile results change, as keys of cached results.
+# 'profiles' only adds results, so it is checked on the cached results
+resultSettings = ('pxSize', 'crop', 'sigma', 'intThres', 'minLen', 'thStep',
+                  'deltaTh', 'wvlen', 'sinPow', 'minArea', 'periodSweep',
+                  'precision', 'engine')
+profileResults = ('profileOffset', 'corrProfile', 'phaseProfile')
+cacheVersion = 4
+
+# Cached results that were not used for this time, in seconds, are removed
+cacheMaxAge = 30*24*3600
+
+
+def loadSettings(filename, tech='STED'):
+    """Analysis settings of a config file as written by tools.saveConfig,
+    for STED or STORM images, in the format of analyzeFile and batch.
+
+    returns:
+
+    settings: dict with the analysis settings and also 'workers', the number
+    of worker processes"""
+
+    config = configparser.ConfigParser()
+    if not config.read(filename):
+        raise ValueError('Could not read config file ' + str(filename))
+    loading = config['Loading']
+    analysisConfig = config['Analysis']
+
+    if tech == 'STED':
+        pxSize = float(loading['STED px nm'])
+        crop = 0
+    elif tech == 'STORM':
+        # 3px borders of the widefield image are cropped, like in Gollum
+        pxSize = float(loading['STORM px nm'])
+        crop = int(3*float(loading['STORM magnification']))
+    else:
+        raise ValueError('Unknown technique ' + str(tech))
+
+    optional = {key: analysisConfig.get(key, default)
+                for key, (widget, default) in tools.optionalSettings.items()}
+
+    return {'pxSize': pxSize, 'crop': crop,
+            'sigma': float(analysisConfig['Gaussian sigma filter nm']),
+            'intThres': float(analysisConfig['nsigmas threshold']),
+            'minLen': float(analysisConfig['Lines min length nm']),
+            'thStep': float(analysisConfig['Angular step deg']),
+            'deltaTh': float(analysisConfig['Delta angle deg']),
+            'wvlen': float(analysisConfig['Ring periodicity nm']),
+            'sinPow': float(analysisConfig['Sinusoidal pattern power']),
+            'minArea': float(analysisConfig['Area threshold %']),
+            'corrThres': float(analysisConfig['Discrimination threshold']),
+            'periodSweep': optional['Period sweep nm'],
+            'precision': tools.checkPrecision(optional['Precision']),
+            'workers': int(optional['Worker processes']), 'engine': 'batch'}
+
+
+def imageFiles(paths):
+    """Tiff files in paths, which can be files or folders (not searched
+    recursively), grouped by folder.
+
+    returns:
+
+    list of lists with the sorted filenames of every folder"""
+
+    extensions = ('.tif', '.tiff')
+    folders = {}
+    for path in paths:
+        if os.path.isdir(path):
+            names = [os.path.join(path, name) for name in os.listdir(path)
+                     if name.lower().endswith(extensions)]
+        else:
+            names = [path]
+        for name in names:
+            folder = os.path.dirname(os.path.abspath(name))
+            folders.setdefault(folder, []).append(name)
+
+    return [sorted(set(names)) for folder, names in sorted(folders.items())]
+
+
+def loadImage(filename, pxSize, crop=0, precision='float64'):
+    """Loads an image like Gollum does. crop pixels are removed from every
+    edge and then the image is cropped to a whole number of 1um blocks.
+
+    returns:
+
+    data: cropped image data
+    initShape: shape of the image in the file
+    n: number of blocks along each axis
+    subimgPxSize: side of the blocks in pixels"""
+
+    initShape, n, subimgPxSize = imageLayout(filename, pxSize, crop)
+
+    # Only the region of the blocks is read
+    edge = crop + n*subimgPxSize
+    data = tools.loadData(filename, precision,
+                          (slice(crop, edge[0]), slice(crop, edge[1])))
+
+    return data, initShape, n, subimgPxSize
+
+
+def imageLayout(filename, pxSize, crop=0):
+    """initShape, n and subimgPxSize of loadImage, read from the file header
+    without loading the image."""
+
+    initShape = tools.imageShape(filename)
+    bound = (np.array(initShape) - crop).astype(int)
+
+    # We need 1um n-sized subimages
+    subimgPxSize = int(1000/pxSize)
+    n = ((bound - crop)/subimgPxSize).astype(int)
+
+    return initShape, n, subimgPxSize
+
+
+def analyzeFile(filename, settings):
+    """Ring analysis of an image file.
+
+    settings: dict with the analysis settings, with the same units as in the
+    GUI: 'pxSize' and 'crop' of the image, 'sigma' of the gaussian filter,
+    'intThres' in sigmas over the mean, 'minLen' of lines, 'thStep',
+    'deltaTh', 'wvlen', 'sinPow', 'minArea' in %, 'periodSweep' (see
+    tools.periodSweep), 'precision' (see tools.loadData), 'engine' and,
+    optionally, 'profiles' to keep the angular profiles of the blocks and
+    'tileBlocks' to analyze the image in tiles with analyzeTiled
+
+    returns:
+
+    dict with the 'initShape', 'crop', 'n' and 'subimgPxSize' of the image,
+    and the block results 'localCorr', 'localTheta', 'localPhase' and
+    'localPeriod' (None without a period sweep) as (n[0], n[1]) arrays. Also
+    the block statistics that thresholds are applied to: 'localMaxZ', the
+    maximum of the smoothed block in standard deviations over the mean of
+    the smoothed image, and 'localNeuronFrac', the fraction of the block
+    that belongs to a neuron. The block directions are in 'localTh0' and,
+    with 'profiles', the angles relative to the directions 'profileOffset'
+    and the (n[0], n[1], angles) 'corrProfile' and 'phaseProfile' of
+    tools.angularProfiles, computed with the 'wvlen' of the settings"""
+
+    if settings.get('tileBlocks'):
+        return analyzeTiled(filename, settings, settings['tileBlocks'])
+
+    image = loadImage(filename, settings['pxSize'], settings['crop'],
+                      settings['precision'])
+    return analyzeImage(*image, settings)
+
+
+def analyzeImage(data, initShape, n, subimgPxSize, settings):
+    """analyzeFile for an image already loaded with loadImage."""
+
+    # Binarization of image
+    dataS = ndi.gaussian_filter(data, settings['sigma']/settings['pxSize'],
+                                output=tools.floatType(data))
+    result = analyzeBlocks(data, dataS, np.mean(dataS), np.std(dataS), n,
+                           subimgPxSize, settings)
+    result.update({'initShape': initShape, 'crop': settings['crop'], 'n': n,
+                   'subimgPxSize': subimgPxSize})
+
+    return result
+
+
+def analyzeBlocks(data, dataS, meanS, stdS, n, subimgPxSize, settings):
+    """Block results of analyzeFile for the (n[0], n[1]) blocks of data and
+    its smoothed version dataS, where meanS and stdS are the mean and
+    standard deviation of the smoothed image."""
+
+    pxSize = settings['pxSize']
+    thres = meanS + settings['intThres']*stdS
+    mask = dataS < thres
+
+    blocksInput = tools.blockshaped(data, subimgPxSize, subimgPxSize)
+    blocksInputS = tools.blockshaped(dataS, subimgPxSize, subimgPxSize)
+    blocksMask = tools.blockshaped(mask, subimgPxSize, subimgPxSize)
+
+    # Block statistics compared with the intensity and area thresholds, kept
+    # for thresholdSweep
+    with np.errstate(divide='ignore', invalid='ignore'):
+        maxZ = (np.max(blocksInputS, (1, 2)) - meanS)/stdS
+    neuronFrac = 1 - np.mean(blocksMask, (1, 2))
+
+    minLen = settings['minLen']/pxSize
+    wvlen = settings['wvlen']/pxSize
+    areaThres = 0.01*settings['minArea']
+    wvlens = tools.periodSweep(settings['periodSweep'])
+    if wvlens is None:
+        output = tools.corrBlocks(blocksInput, blocksInputS, blocksMask,
+                                  thres, areaThres, minLen,
+                                  settings['thStep'], settings['deltaTh'],
+                                  wvlen, settings['sinPow'],
+                                  settings['engine'])
+        localPeriod = None
+    else:
+        output = tools.periodBlocks(blocksInput, blocksInputS, blocksMask,
+                                    thres, areaThres, minLen,
+                                    settings['thStep'], settings['deltaTh'],
+                                    wvlens/pxSize, settings['sinPow'],
+                                    settings['engine'])
+        localPeriod = pxSize*output[4].reshape(*n)
+
+    result = {'localTh0': output[0].reshape(*n),
+              'localCorr': output[1].reshape(*n),
+              'localTheta': output[2].reshape(*n),
+              'localPhase': output[3].reshape(*n), 'localPeriod': localPeriod,
+              'localMaxZ': maxZ.reshape(*n),
+              'localNeuronFrac': neuronFrac.reshape(*n)}
+
+    if settings.get('profiles', False):
+        offsets, corrProfile, phaseProfile = tools.angularProfiles(
+            blocksInput, blocksMask, output[0], settings['thStep'],
+            settings['deltaTh'], wvlen, settings['sinPow'],
+            settings['engine'])
+        result['profileOffset'] = offsets
+        result['corrProfile'] = corrProfile.reshape(*n, -1)
+        result['phaseProfile'] = phaseProfile.reshape(*n, -1)
+
+    return result
+
+
+def analyzeTiled(filename, settings, tileBlocks=8):
+    """analyzeFile for images larger than the memory, which are analyzed in
+    tiles of tileBlocks x tileBlocks blocks.
+
+    Tiles are read with a margin of the size of the gaussian filter kernel,
+    so their smoothed data is the same as the one of the whole image. A first
+    pass over the tiles computes the mean and standard deviation of the
+    smoothed image for the intensity threshold, and a second one analyzes
+    the blocks of every tile. Only the tile being analyzed and the block
+    results are kept in memory. Results are the ones of analyzeFile, up to
+    the rounding of the mean and standard deviation."""
+
+    pxSize = settings['pxSize']
+    crop = settings['crop']
+    initShape, n, subimgPxSize = imageLayout(filename, pxSize, crop)
+    size = n*subimgPxSize
+
+    # Same kernel radius as ndi.gaussian_filter
+    sigma = settings['sigma']/pxSize
+    margin = int(4.0*sigma + 0.5)
+
+    tiles = [(r, c, min(r + tileBlocks, n[0]), min(c + tileBlocks, n[1]))
+             for r in range(0, n[0], tileBlocks)
+             for c in range(0, n[1], tileBlocks)]
+
+    def loadTile(r0, c0, r1, c1):
+        # Pixels of the tile and its margin within the analyzed region
+        start = np.array((r0, c0))*subimgPxSize
+        stop = np.array((r1, c1))*subimgPxSize
+        first = np.maximum(start - margin, 0)
+        last = np.minimum(stop + margin, size)
+        data = tools.loadData(filename, settings['precision'],
+                              (slice(crop + first[0], crop + last[0]),
+                               slice(crop + first[1], crop + last[1])))
+        dataS = ndi.gaussian_filter(data, sigma,
+                                    output=tools.floatType(data))
+        core = (slice(start[0] - first[0], stop[0] - first[0]),
+                slice(start[1] - first[1], stop[1] - first[1]))
+        return data[core], dataS[core]
+
+    # Mean and standard deviation of the smoothed image, merging the ones of
+    # every tile
+    stats = moments([])
+    for tile in tiles:
+        dataS = loadTile(*tile)[1].astype(np.float64)
+        stats = mergeMoments(stats, moments(dataS))
+    count, meanS, m2 = stats
+    stdS = np.sqrt(m2/count)
+
+    result = {}
+    for r0, c0, r1, c1 in tiles:
+        data, dataS = loadTile(r0, c0, r1, c1)
+        tileResult = analyzeBlocks(data, dataS, meanS, stdS,
+                                   (r1 - r0, c1 - c0), subimgPxSize, settings)
+        for name, value in tileResult.items():
+            if name == 'profileOffset' or value is None:
+                result[name] = value
+                continue
+            if name not in result:
+                result[name] = np.full(tuple(n) + value.shape[2:], np.nan,
+                                       value.dtype)
+            result[name][r0:r1, c0:c1] = value
+
+    result.update({'initShape': initShape, 'crop': crop, 'n': n,
+                   'subimgPxSize': subimgPxSize})
+
+    return result
+
+
+def prefetch(function, items, depth=2):
+    """Iterator over function(item) for every item, where the next depth
+    items are processed ahead in a background thread. Used to read and
+    decode files while the current one is analyzed."""
+
+    items = iter(items)
+    with ThreadPoolExecutor(1) as reader:
+        ahead = [reader.submit(function, item)
+                 for item in itertools.islice(items, depth)]
+        for item in items:
+            ahead.append(reader.submit(function, item))
+            yield ahead.pop(0).result()
+        for future in ahead:
+            yield future.result()
+
+
+def usedSettings(settings):
+    """Representation of the settings that change analyzeFile results, with
+    numbers as floats so that it does not depend on their types."""
+
+    used = [cacheVersion]
+    for name in resultSettings:
+        value = settings.get(name)
+        used.append(float(value) if isinstance(value, numbers.Number)
+                    else value)
+    return repr(used).encode()
+
+
+def settingsKey(settings):
+    """Hash of the settings that change analyzeFile results, to tell apart
+    results of different analyses of the same images."""
+
+    return hashlib.sha256(usedSettings(settings)).hexdigest()
+
+
+def fileHash(filename, index=None):
+    """Hash of the content of a file. It is only read when it is not in
+    index or its size or modification time changed since it was hashed.
+
+    index: optional dict with the hashes of files by their absolute path,
+    as kept by loadIndex and saveIndex, updated with the new hashes"""
+
+    if index is None:
+        index = {}
+
+    path = os.path.abspath(filename)
+    stat = os.stat(path)
+    stamp = [stat.st_size, stat.st_mtime_ns]
+    known = index.get(path)
+    if known is not None and known[:2] == stamp:
+        return known[2]
+
+    content = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            content.update(chunk)
+    index[path] = stamp + [content.hexdigest()]
+
+    return content.hexdigest()
+
+
+def resultKey(filename, settings, index=None):
+    """Hash of the content of an image file (see fileHash) and of the
+    settings that change its analyzeFile results, used to find them in a
+    cache."""
+
+    key = hashlib.sha256(fileHash(filename, index).encode())
+    key.update(usedSettings(settings))
+
+    return key.hexdigest()
+
+
+def loadIndex(cacheDir):
+    """Hashes of the files of fileHash kept in the cache folder cacheDir."""
+
+    try:
+        with open(os.path.join(cacheDir, 'index.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def saveIndex(cacheDir, index):
+    """Saves the hashes of the files of fileHash to the cache folder, only
+    for the files that still exist."""
+
+    os.makedirs(cacheDir, exist_ok=True)
+    index = {path: value for path, value in index.items()
+             if os.path.exists(path)}
+    filename = os.path.join(cacheDir, 'index.json')
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(filename + '.tmp', filename)
+
+
+def pruneCache(cacheDir, maxAge=cacheMaxAge):
+    """Removes the results of the cache folder cacheDir that were not used
+    for maxAge seconds. Results are marked as used by analyzeFiles, by
+    updating their modification time.
+
+    returns:
+
+    number of removed results"""
+
+    removed = 0
+    limit = time.time() - maxAge
+    for name in os.listdir(cacheDir):
+        filename = os.path.join(cacheDir, name)
+        if name.endswith(('.npz', '.npz.tmp')):
+            try:
+                if os.path.getmtime(filename) < limit:
+                    os.remove(filename)
+                    removed += name.endswith('.npz')
+            except OSError:
+                pass
+
+    return removed
+
+
+def hasResult(cacheDir, key, profiles=False):
+    """Whether the cache folder cacheDir has the analyzeFile results of key,
+    with the angular profiles of the blocks if profiles, without loading
+    them."""
+
+    try:
+        with np.load(os.path.join(cacheDir, key + '.npz')) as cached:
+            return not profiles or 'corrProfile' in cached.files
+    except (OSError, ValueError):
+        return False
+
+
+def loadResult(cacheDir, key):
+    """analyzeFile results saved with saveResult, or None if they are not
+    in the cache."""
+
+    try:
+        with np.load(os.path.join(cacheDir, key + '.npz')) as cached:
+            result = {name: cached[name] for name in cached.files}
+    except (OSError, ValueError, KeyError):
+        return None
+
+    result['crop'] = int(result['crop'])
+    result['subimgPxSize'] = int(result['subimgPxSize'])
+    result['initShape'] = tuple(result['initShape'])
+    result.setdefault('localPeriod', None)
+
+    return result
+
+
+def saveResult(cacheDir, key, result):
+    """Saves analyzeFile results to the cache folder cacheDir."""
+
+    os.makedirs(cacheDir, exist_ok=True)
+    arrays = {name: value for name, value in result.items()
+              if value is not None}
+
+    # Written under a temporary name, so that interrupted runs do not leave
+    # broken results in the cache
+    filename = os.path.join(cacheDir, key + '.npz')
+    with open(filename + '.tmp', 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(filename + '.tmp', filename)
+
+
+def analyzeFiles(filenames, settings, pool=None, depth=2, cacheDir=None):
+    """Iterator over the analyzeFile results of filenames, in order.
+
+    Without a pool, the next depth files are loaded in a background thread
+    while the current one is analyzed in this process. With a pool (see
+    tools.processPool), files are loaded and analyzed in the workers.
+
+    cacheDir: optional folder where results are kept by resultKey. Files
+    whose results are there are not analyzed again. Files are only read to
+    find their keys if they changed since the last run (see fileHash), and
+    results that were not used for cacheMaxAge are removed (see
+    pruneCache)."""
+
+    if cacheDir is None:
+        return computeFiles(filenames, settings, pool, depth)
+
+    index = loadIndex(cacheDir)
+    keys = [resultKey(filename, settings, index) for filename in filenames]
+    saveIndex(cacheDir, index)
+
+    # Results are loaded from the cache only when they are used. Cached
+    # results without angular profiles are computed again when they are
+    # needed, and their profiles are dropped when they are not
+    profiles = bool(settings.get('profiles'))
+    cached = [hasResult(cacheDir, key, profiles) for key in keys]
+    for key, hit in zip(keys, cached):
+        if hit:
+            os.utime(os.path.join(cacheDir, key + '.npz'))
+    pruneCache(cacheDir)
+    missing = [filename for filename, hit in zip(filenames, cached)
+               if not hit]
+    computed = computeFiles(missing, settings, pool, depth)
+
+    def results():
+        for filename, key, hit in zip(filenames, keys, cached):
+            result = loadResult(cacheDir, key) if hit else None
+            if result is None:
+                result = next(computed) if not hit else analyzeFile(
+                    filename, settings)
+                saveResult(cacheDir, key, result)
+            elif not profiles:
+                for name in profileResults:
+                    result.pop(name, None)
+            yield result
+
+    return results()
+
+
+def computeFiles(filenames, settings, pool=None, depth=2):
+    """analyzeFiles without a cache."""
+
+    if pool is not None:
+        return pool.map(analyzeFile, filenames, [settings]*len(filenames))
+    if settings.get('tileBlocks'):
+        # Tiles are read as they are analyzed
+        return (analyzeFile(filename, settings) for filename in filenames)
+
+    def load(filename):
+        return loadImage(filename, settings['pxSize'], settings['crop'],
+                         settings['precision'])
+
+    return (analyzeImage(*image, settings)
+            for image in prefetch(load, filenames, depth))
+
+
+def saveMap(filename, localMap, initShape, crop, subimgPxSize, pxSize):
+    """Saves a map of block results expanded to the shape of the image, nan
+    outside the blocks, with the metadata of the Gollum results. The file is
+    written one row of blocks at a time, so the expanded map is never in
+    memory."""
+
+    image = tiff.memmap(filename, shape=tuple(initShape), dtype=np.single,
+                        software='Gollum', imagej=True,
+                        resolution=(1000/pxSize, 1000/pxSize),
+                        metadata={'spacing': 1, 'unit': 'um'})
+    image[:] = np.nan
+    width = localMap.shape[1]*subimgPxSize
+    for row, values in enumerate(localMap):
+        top = crop + row*subimgPxSize
+        image[top:top + subimgPxSize, crop:crop + width] = np.repeat(
+            values.astype(np.single), subimgPxSize)
+    image.flush()
+    del image
+
+
+def moments(values):
+    """Number, mean and sum of squared deviations from the mean of values,
+    to be merged with mergeMoments."""
+
+    values = np.ravel(values)
+    if values.size == 0:
+        return 0, 0.0, 0.0
+    mean = np.mean(values)
+    return values.size, mean, np.sum((values - mean)**2)
+
+
+def mergeMoments(a, b):
+    """moments of the values of a and b together, from their moments, like
+    Welford's running variance for groups of values (Chan et al.)."""
+
+    count = a[0] + b[0]
+    if count == 0:
+        return a
+    delta = b[1] - a[1]
+    mean = a[1] + delta*b[0]/count
+    return count, mean, a[2] + b[2] + delta**2*a[0]*b[0]/count
+
+
+class BatchStats:
+    """Statistics of the correlations of the files of a batch, updated with
+    the block correlations of every file as soon as it is analyzed.
+
+    Only the moments (see moments) of the correlations and of the ring
+    correlations of every file, and a histogram of fixed bins in the range
+    of the correlations are kept, so the statistics of batch are available
+    at any time without keeping the correlations.
+
+    corrThres: discrimination threshold of rings
+    bins: bins of the histogram of the correlations in [-1, 1]"""
+
+    def __init__(self, corrThres, bins=100):
+
+        self.corrThres = corrThres
+        self.histEdges = self.binEdges(bins)
+        self.hist = np.zeros(bins, dtype=int)
+        self.corrMoments = ([], [], [])
+        self.ringMoments = ([], [], [])
+
+    @staticmethod
+    def binEdges(bins):
+        """Edges of the fixed histogram bins in [-1, 1]."""
+
+        return np.linspace(-1, 1, bins + 1)
+
+    def add(self, localCorr):
+        """Adds the block correlations of a file, nan for blocks without
+        neurons."""
+
+        corr = np.ravel(localCorr)
+        corr = corr[~np.isnan(corr)]
+        for stats, values in ((self.corrMoments, corr),
+                              (self.ringMoments, corr[corr > self.corrThres])):
+            for fileStats, value in zip(stats, moments(values)):
+                fileStats.append(value)
+
+        values = np.clip(corr, self.histEdges[0], self.histEdges[-1])
+        self.hist += np.histogram(values, self.histEdges)[0]
+
+    def summary(self):
+        """Statistics of the files added so far.
+
+        returns:
+
+        dict with the statistics of aggregate.groupStats for all the files,
+        and the histogram 'hist' and its 'histEdges', like thresholdSweep"""
+
+        corrMoments = [np.array(m, dtype=float) for m in self.corrMoments]
+        ringMoments = [np.array(m, dtype=float) for m in self.ringMoments]
+        groups = np.zeros(len(corrMoments[0]), dtype=int)
+        stats = aggregate.groupStats(corrMoments, ringMoments, groups, 1)
+        summary = {name: value[0] for name, value in stats.items()}
+        summary.update({'hist': self.hist, 'histEdges': self.histEdges})
+        return summary
+
+
+class BlocksFile:
+    """blocks.npz file of batch, written one file of the batch at a time.
+
+    The block results of every file are written to .npy files in a
+    temporary folder as soon as they are added, and packed in the npz file
+    by close, so only the results of one file are in memory.
+
+    filename: name of the npz file
+    nfiles: number of files of the batch"""
+
+    def __init__(self, filename, nfiles):
+
+        self.filename = filename
+        self.nfiles = nfiles
+        self.tmpDir = filename + '.tmp'
+        os.makedirs(self.tmpDir, exist_ok=True)
+        self.arrays = {}
+
+    def add(self, i, **arrays):
+        """Writes the arrays of file i, whose first file sets their shape
+        and type."""
+
+        for name, value in arrays.items():
+            if name not in self.arrays:
+                value = np.asarray(value)
+                self.arrays[name] = np.lib.format.open_memmap(
+                    os.path.join(self.tmpDir, name + '.npy'), 'w+',
+                    value.dtype, (self.nfiles, ) + value.shape)
+            self.arrays[name][i] = value
+
+    def close(self, **values):
+        """Writes the npz file with the arrays of all the files and values,
+        and removes the temporary folder."""
+
+        names = list(self.arrays)
+        for array in self.arrays.values():
+            array.flush()
+        self.arrays = {}
+
+        with zipfile.ZipFile(self.filename, 'w', allowZip64=True) as npz:
+            for name in names:
+                npz.write(os.path.join(self.tmpDir, name + '.npy'),
+                          name + '.npy')
+            for name, value in values.items():
+                data = io.BytesIO()
+                np.save(data, np.asarray(value))
+                npz.writestr(name + '.npy', data.getvalue())
+        shutil.rmtree(self.tmpDir)
+
+
+def resultMaps(localCorr, localPeriod, corrThres):
+    """Block maps of the results of a file that are saved as images, with
+    the suffix of their file names. Blocks are compared with the
+    discrimination threshold with the precision of the saved correlations.
+
+    returns:
+
+    list of (suffix, map) for the correlation, ring and, with a period
+    sweep, ring period maps"""
+
+    corr = np.asarray(localCorr, dtype=np.single)
+    with np.errstate(invalid='ignore'):
+        rings = np.where(np.isnan(corr), np.nan, corr >= corrThres)
+    maps = [('_correlation', corr), ('_rings', rings)]
+    if localPeriod is not None:
+        maps.append(('_period', localPeriod))
+    return maps
+
+
+def saveMaps(blocksName, files=None, corrThres=None):
+    """Saves the correlation, ring and ring period images of the files of a
+    batch from the block results of its blocks.npz file, like batch does
+    with maps=True.
+
+    files: names of the files, default all the files of the batch
+    corrThres: discrimination threshold of the rings, default the one of
+    the analysis
+
+    returns:
+
+    list with the names of the saved images"""
+
+    resultsDir = os.path.split(blocksName)[0]
+    with np.load(blocksName) as blocks:
+        if 'initShape' not in blocks:
+            raise ValueError('Block results have no image geometry')
+        layout = (tuple(blocks['initShape']), int(blocks['crop']),
+                  int(blocks['subimgPxSize']), float(blocks['pxSize']))
+        names = list(blocks['files'])
+        corr = blocks['corr']
+        period = blocks['period'] if 'period' in blocks else None
+        if corrThres is None:
+            corrThres = float(blocks['corrThres'])
+
+    saved = []
+    for name in (names if files is None else files):
+        if name not in names:
+            raise ValueError(name + ' is not in the batch')
+        i = names.index(name)
+        localPeriod = None if period is None else period[i]
+        for suffix, localMap in resultMaps(corr[i], localPeriod, corrThres):
+            mapName = utils.insertSuffix(os.path.join(resultsDir, name),
+                                         suffix)
+            saveMap(mapName, localMap, *layout)
+            saved.append(mapName)
+    return saved
+
+
+def batch(filenames, settings, pool=None, progress=None, cache=True,
+          maps=True, store=None):
+    """Analysis of a batch of images from the same folder, as done by Gollum.
+    The correlation, ring period and ring images of every file, the
+    correlation values and their histogram are saved in a results folder
+    next to the images, and the block results and statistics of all files
+    for thresholdSweep, the geometry of the images for saveMaps, and their
+    angular profiles if they were kept (see analyzeFile), in its blocks.npz
+    file.
+
+    settings: see analyzeFile, and also 'corrThres', the discrimination
+    threshold of rings
+    pool: see analyzeFiles
+    progress: optional function called with the name of every file when its
+    results are saved
+    cache: if True, the results of every file are kept in a cache folder
+    inside the results folder, and files that did not change since a
+    previous run with the same settings are not analyzed again
+    maps: if False, the images of the results are not saved, and they can
+    be saved later from the blocks.npz file with saveMaps
+    store: optional resultstore.ResultStore where the block results of
+    every file are also added, with the folder of the images as their
+    condition
+
+    Results are written as every file is analyzed, and only the statistics
+    of the batch are kept in memory (see BatchStats).
+
+    returns:
+
+    blocksName: blocks.npz file, in the folder with the results
+    summary: BatchStats.summary of the batch"""
+
+    nfiles = len(filenames)
+    pxSize = settings['pxSize']
+    corrThres = settings['corrThres']
+
+    path = os.path.split(filenames[0])[0]
+    folder = os.path.split(path)[1]
+    print('Processing folder', path)
+    t0 = time.time()
+
+    # Make results directory if it doesn't exist
+    resultsDir = os.path.join(path, 'results')
+    if not os.path.exists(resultsDir):
+        os.makedirs(resultsDir)
+    resNames = [utils.insertFolder(p, 'results') for p in filenames]
+
+    # Files are read ahead of the analysis, or analyzed concurrently in the
+    # worker pool, and their results are saved in order in a writer thread
+    # as they become available
+    cacheDir = os.path.join(resultsDir, 'cache') if cache else None
+    results = analyzeFiles(filenames, settings, pool, cacheDir=cacheDir)
+    writer = ThreadPoolExecutor(1)
+    saves = []
+    if store is not None:
+        params = settingsKey(settings)
+
+    # Statistics, correlation values and block results of every file are
+    # added as soon as its results are available
+    stats = BatchStats(corrThres)
+    blocksName = os.path.join(resultsDir, folder + 'blocks.npz')
+    blocks = BlocksFile(blocksName, nfiles)
+    valuesTxt = open(os.path.join(resultsDir, folder + 'corr_values.txt'),
+                     'w')
+
+    for i, result in enumerate(results):
+        name = os.path.split(filenames[i])[1]
+        print(name)
+        if progress is not None:
+            progress(name)
+
+        # All the images of the batch have the shape of the first one, and
+        # the block results for thresholdSweep, the ring periods if there
+        # was a period sweep and the angular profiles of the blocks for
+        # tools.profileMax if they were kept
+        if i == 0:
+            initShape = result['initShape']
+        blocks.add(i, corr=np.asarray(result['localCorr'], dtype=float),
+                   maxZ=np.asarray(result['localMaxZ'], dtype=float),
+                   neuronFrac=np.asarray(result['localNeuronFrac'],
+                                         dtype=float),
+                   th0=np.asarray(result['localTh0'], dtype=float))
+        if result['localPeriod'] is not None:
+            blocks.add(i, period=result['localPeriod'])
+        if 'corrProfile' in result:
+            blocks.add(i, corrProfile=result['corrProfile'],
+                       phaseProfile=result['phaseProfile'])
+            profileOffset = result['profileOffset']
+        if store is not None:
+            store.addFile(os.path.abspath(path), name, params, result)
+
+        stats.add(result['localCorr'])
+        localCorr = np.ravel(result['localCorr'])
+        validCorr = localCorr[~np.isnan(localCorr)]
+        fileIndex = np.full(validCorr.size, i)
+        np.savetxt(valuesTxt, np.stack((validCorr, fileIndex), 1),
+                   fmt='%f\t%i')
+
+        # Save correlation, ring and ring period images, with the result
+        # maps expanded so they match data shape
+        layout = (initShape, result['crop'], result['subimgPxSize'], pxSize)
+        if maps:
+            for suffix, localMap in resultMaps(result['localCorr'],
+                                               result['localPeriod'],
+                                               corrThres):
+                mapName = utils.insertSuffix(resNames[i], suffix)
+                saves.append(writer.submit(saveMap, mapName, localMap,
+                                           *layout))
+
+    # Wait for all the images to be written
+    valuesTxt.close()
+    writer.shutdown()
+    for save in saves:
+        save.result()
+
+    # Save the block results with the thresholds and engine of the
+    # analysis, the geometry of the images for saveMaps and the angles of
+    # the profiles
+    values = {}
+    if 'corrProfile' in blocks.arrays:
+        values['profileOffset'] = profileOffset
+    blocks.close(files=[os.path.split(f)[1] for f in filenames],
+                 intThres=settings['intThres'], minArea=settings['minArea'],
+                 corrThres=corrThres, deltaTh=settings['deltaTh'],
+                 engine=settings['engine'], initShape=initShape,
+                 crop=layout[1], subimgPxSize=layout[2], pxSize=pxSize,
+                 **values)
+
+    # Histogram of the correlation values, in the range of the bins with
+    # values
+    summary = stats.summary()
+    filled = np.flatnonzero(summary['hist'])
+    filled = slice(filled[0], filled[-1] + 1) if filled.size else slice(None)
+    y = summary['hist'][filled]
+    x = (summary['histEdges'][1:] + summary['histEdges'][:-1])[filled]/2
+
+    # Plotting, on an Agg canvas so that no GUI toolkit is loaded
+    with matplotlib.style.context('ggplot'):
+        fig = Figure(figsize=(10, 7.5))
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot()
+        width = summary['histEdges'][1] - summary['histEdges'][0]
+        ax.bar(x, y, align='center', width=width, color="#3F5D7D")
+        ax.plot((corrThres, corrThres), (0, np.max(y)), '--', color='r',
+                linewidth=2)
+        text = ('Pearson coefficient threshold = {0:.2f} \n'
+                'n = {1}; nrings = {2} \n'
+                'PSS fraction = {3:.2f} $\\pm$ {4:.2f} \n'
+                'mean coefficient = {5:.3f} $\\pm$ {6:.3f}\n'
+                'mean ring coefficient = {7:.3f} $\\pm$ {8:.3f}')
+        text = text.format(corrThres, summary['n'], summary['nrings'],
+                           summary['pssFrac'], summary['pssFracStd'],
+                           summary['meanCorr'], summary['corrStd'],
+                           summary['meanRingCorr'], summary['ringCorrStd'])
+        ax.text(0.75*ax.axis()[1], 0.83*ax.axis()[3], text,
+                horizontalalignment='center', verticalalignment='center',
+                bbox=dict(facecolor='white'), fontsize=20)
+        ax.set_xlabel('Pearson correlation coefficient', fontsize=35)
+        ax.tick_params(axis='both', labelsize=25)
+        ax.grid()
+        fig.tight_layout()
+        fig.savefig(os.path.join(resultsDir, folder + 'corr_hist.pdf'),
+                    dpi=300)
+        fig.savefig(os.path.join(resultsDir, folder + 'corr_hist.png'),
+                    dpi=300)
+
+    text = 'Folder ' + folder + ' done in {0:.0f} seconds'
+    print(text.format(time.time() - t0))
+
+    return blocksName, summary
+
+
+def thresholdSweep(corr, maxZ, neuronFrac, corrThres, intThres, minArea,
+                   bins=100):
+    """Batch statistics for a grid of thresholds, computed from the block
+    results saved by batch instead of analyzing the images again.
+
+    Blocks are selected by their 'localMaxZ' and 'localNeuronFrac' (see
+    analyzeFile) like the intensity and area thresholds do, but the neuron
+    mask and the correlations are the ones of the analysis, so intensity
+    and area thresholds below the analyzed ones add no blocks.
+
+    corr, maxZ, neuronFrac: (nfiles, ...) block results of every file
+    corrThres: increasing discrimination thresholds of rings
+    intThres: intensity thresholds in sigmas over the mean
+    minArea: area thresholds in %
+    bins: bins of the correlation histograms in [-1, 1], as in BatchStats
+
+    returns:
+
+    dict with arrays of shape (len(intThres), len(minArea), len(corrThres))
+    with the statistics of the batch histogram: 'n' blocks, 'nrings', their
+    'ringFrac', PSS fraction 'pssFrac' (mean of the ring fractions of every
+    file) and its 'pssFracStd', 'meanCorr' and 'corrStd', 'meanRingCorr'
+    and 'ringCorrStd'. Also the correlation histograms 'hist' with shape
+    (len(intThres), len(minArea), bins) and their 'histEdges'"""
+
+    corrThres = np.asarray(corrThres, dtype=float)
+    intThres = np.asarray(intThres, dtype=float)
+    minArea = np.asarray(minArea, dtype=float)
+    nI, nA, nC = len(intThres), len(minArea), len(corrThres)
+
+    nfiles = len(corr)
+    corr = np.reshape(corr, (nfiles, -1))
+    maxZ = np.reshape(maxZ, (nfiles, -1))
+    neuronFrac = np.reshape(neuronFrac, (nfiles, -1))
+    valid = ~np.isnan(corr)
+    values = np.where(valid, corr, 0)
+
+    # Blocks selected by every pair of intensity and area thresholds, with
+    # shape (nI, nA, nfiles, blocks)
+    with np.errstate(invalid='ignore'):
+        selected = (valid & (maxZ > intThres[:, None, None, None]) &
+                    (neuronFrac > 0.01*minArea[:, None, None]))
+    nFile = np.sum(selected, -1)
+    sumFile = np.sum(selected*values, -1)
+    sum2File = np.sum(selected*values**2, -1)
+
+    # A block is a ring for the thresholds of corrThres below its value, so
+    # the ring sums of all of them come from the cumulative sums of one
+    # bincount of the blocks by their number of thresholds below
+    below = np.searchsorted(corrThres, values, 'left')
+    groups = np.arange(nI*nA*nfiles).reshape(nI, nA, nfiles, 1)
+    groups = groups*(nC + 1) + below
+    size = nI*nA*nfiles*(nC + 1)
+
+    def ringSums(weights):
+        sums = np.bincount(groups.ravel(), (selected*weights).ravel(), size)
+        sums = sums.reshape(nI, nA, nfiles, nC + 1)
+        return np.cumsum(sums[..., ::-1], -1)[..., ::-1][..., 1:]
+
+    nRingFile = ringSums(1).astype(int)
+    sumRingFile = ringSums(values)
+    sum2RingFile = ringSums(values**2)
+
+    # Statistics of every combination of thresholds, with shape
+    # (nI, nA, nC), from the moments of every file (see aggregate)
+    corrMoments = [np.broadcast_to(m[:, :, np.newaxis], (nI, nA, nC, nfiles))
+                   for m in aggregate.sumMoments(nFile, sumFile, sum2File)]
+    ringMoments = [np.moveaxis(m, -1, 2)
+                   for m in aggregate.sumMoments(nRingFile, sumRingFile,
+                                                 sum2RingFile)]
+    groups = np.repeat(np.arange(nI*nA*nC), nfiles)
+    stats = aggregate.groupStats([np.ravel(m) for m in corrMoments],
+                                 [np.ravel(m) for m in ringMoments], groups,
+                                 nI*nA*nC)
+    stats = {name: value.reshape(nI, nA, nC)
+             for name, value in stats.items()}
+
+    # Histograms with the fixed bins of the batch histogram
+    histEdges = BatchStats.binEdges(bins)
+    binIndex = np.clip(np.searchsorted(histEdges, values, 'right') - 1, 0,
+                       bins - 1)
+    groups = np.arange(nI*nA).reshape(nI, nA, 1, 1)*bins + binIndex
+    hist = np.bincount(groups.ravel(), selected.ravel(), nI*nA*bins)
+
+    stats.update({'hist': hist.reshape(nI, nA, bins),
+                  'histEdges': histEdges})
+    return stats
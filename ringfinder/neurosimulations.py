@@ -6,6 +6,10 @@ Created on Tue Jul 12 10:51:00 2016
 @pep8: Federico Barabas
 """
 
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
 import numpy as np
 
 
@@ -62,15 +66,174 @@ class simAxon(sin2D):
         self.theta = theta         # grating orientation
         self.phase = phase         # phase (0 -> 1)
 
-        if b % 2 == 0:
-            # sin2D.sin2d squared in order to always get positive values
-            self.grating2 = sin2D(self.imSize, 2*self.wvlen, 90 - self.theta,
-                                  self.phase).sin2d**b
-
-        else:
-            # sin2D.sin2d squared in order to always get positive values
-            self.grating2 = sin2D(self.imSize, self.wvlen, 90 - self.theta,
-                                  self.phase).sin2d**b
+        self.grating2 = axonPattern(self.imSize, self.wvlen, self.theta,
+                                    self.phase, b)
 
         # Make simulated axon data
         self.data = self.grating2
+
+
+def axonPattern(imSize, wvlen, theta, phase, b):
+    """Pattern of a simulated axon, the same as simAxon(...).data but without
+    building the intermediate objects."""
+
+    if b % 2 == 0:
+        # sin2D.sin2d squared in order to always get positive values
+        return sin2D(imSize, 2*wvlen, 90 - theta, phase).sin2d**b
+
+    else:
+        # sin2D.sin2d squared in order to always get positive values
+        return sin2D(imSize, wvlen, 90 - theta, phase).sin2d**b
+
+
+def axonHarmonics(b):
+    """Fourier decomposition of the simulated axon profile sin(u)**b.
+
+    returns:
+
+    orders: harmonic orders j > 0 present in the profile
+    alpha, beta: coefficients such that, up to a constant,
+    sin(u)**b = sum(alpha*cos(orders*u) + beta*sin(orders*u))"""
+
+    # More than 2*b samples, so that no harmonic is aliased
+    nSamples = max(64, 4*int(b))
+    u = 2*np.pi*np.arange(nSamples)/nSamples
+    coefs = np.fft.rfft(np.sin(u)**b)/nSamples
+    orders = np.arange(len(coefs))
+    keep = np.logical_and(orders > 0, np.abs(coefs) > 1e-10)
+
+    return orders[keep], 2*coefs.real[keep], -2*coefs.imag[keep]
+
+
+def axonBasis(imSize, wvlen, theta, b, orders=None):
+    """cos(j*x) and sin(j*x) images, flattened, for every harmonic order j of
+    axonHarmonics(b), or for the given orders. x is the phase-free argument
+    of the grating used by axonPattern, so any of its patterns is a
+    combination of these images."""
+
+    if b % 2 == 0:
+        x = sin2D(imSize, 2*wvlen, 90 - theta, 0).XYf.ravel()
+    else:
+        x = sin2D(imSize, wvlen, 90 - theta, 0).XYf.ravel()
+
+    if orders is None:
+        orders = axonHarmonics(b)[0]
+    jx = np.outer(orders, x)
+
+    return np.concatenate((np.cos(jx), np.sin(jx)))
+
+
+class TemplateBank:
+    """Bounded LRU cache of simulated axon patterns.
+
+    Patterns are keyed by (imSize, wvlen, theta, phase, b), so the same
+    template is synthesized only once no matter how many blocks or images
+    are correlated against it. The bank holds at most maxBytes of arrays,
+    evicting the least recently used ones first. Returned arrays are shared
+    between callers and therefore read-only."""
+
+    def __init__(self, maxBytes=256*2**20):
+
+        self.maxBytes = maxBytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._bypass = threading.local()
+
+    def __len__(self):
+        return len(self._items)
+
+    def lookup(self, key, build):
+        """Returns the cached value for key, calling build() to create it if
+        it is not in the bank. Values are arrays or tuples of arrays."""
+
+        if getattr(self._bypass, 'active', False):
+            return build()
+
+        with self._lock:
+            try:
+                value = self._items[key]
+                self._items.move_to_end(key)
+                self.hits += 1
+                return value
+            except KeyError:
+                self.misses += 1
+
+        value = build()
+        arrays = value if isinstance(value, tuple) else (value, )
+        for arr in arrays:
+            arr.flags.writeable = False
+        size = sum(arr.nbytes for arr in arrays)
+
+        with self._lock:
+            if key not in self._items:
+                self._items[key] = value
+                self.nbytes += size
+            while self.nbytes > self.maxBytes and len(self._items) > 1:
+                old = self._items.popitem(last=False)[1]
+                old = old if isinstance(old, tuple) else (old, )
+                self.nbytes -= sum(arr.nbytes for arr in old)
+
+        return value
+
+    @contextmanager
+    def bypass(self):
+        """Within this context, lookups of the calling thread build their
+        values without storing them, so one-off templates don't evict the
+        useful ones."""
+
+        self._bypass.active = True
+        try:
+            yield
+        finally:
+            self._bypass.active = False
+
+    def get(self, imSize, wvlen, theta, phase, b, dtype=np.float64):
+        """simAxon(imSize, wvlen, theta, phase, b=b).data, from the bank.
+        Like in the other methods, dtype is the type of the returned
+        arrays."""
+
+        key = ('axon', int(imSize), float(wvlen), float(theta), float(phase),
+               float(b), np.dtype(dtype).str)
+        return self.lookup(key, lambda: axonPattern(
+            imSize, wvlen, theta, phase, b).astype(dtype))
+
+    def stack(self, imSize, wvlen, theta, phases, b, dtype=np.float64):
+        """Flattened patterns for every phase at a given angle, as a
+        (len(phases), imSize**2) array, together with their squares."""
+
+        key = ('stack', int(imSize), float(wvlen), float(theta),
+               tuple(float(p) for p in phases), float(b),
+               np.dtype(dtype).str)
+
+        def build():
+            patterns = np.array([axonPattern(imSize, wvlen, theta, p, b)
+                                 for p in phases])
+            patterns = patterns.reshape(len(phases), -1)
+            return patterns.astype(dtype), (patterns**2).astype(dtype)
+
+        return self.lookup(key, build)
+
+    def basis(self, imSize, wvlen, theta, b, orders=None, dtype=np.float64):
+        """axonBasis(imSize, wvlen, theta, b, orders), from the bank."""
+
+        key = ('basis', int(imSize), float(wvlen), float(theta), float(b),
+               np.dtype(dtype).str)
+        if orders is not None:
+            key += (tuple(int(j) for j in orders),)
+        return self.lookup(key, lambda: axonBasis(
+            imSize, wvlen, theta, b, orders).astype(dtype))
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+
+# Template bank shared by every analysis in the session
+templateBank = TemplateBank()
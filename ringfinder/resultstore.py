@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Results of every block of the analyzed images in one SQLite database, so
+that statistics across folders and analyses are queried without reading the
+result files of every folder.
+"""
+
+import sqlite3
+import itertools
+import numpy as np
+
+import ringfinder.aggregate as aggregate
+
+
+schema = '''
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    folder TEXT NOT NULL,
+    name TEXT NOT NULL,
+    params TEXT NOT NULL,
+    UNIQUE (params, folder, name)
+);
+CREATE TABLE IF NOT EXISTS blocks (
+    file INTEGER NOT NULL REFERENCES files (id),
+    block INTEGER NOT NULL,
+    corr REAL,
+    theta REAL,
+    phase REAL,
+    th0 REAL,
+    maxZ REAL,
+    neuronFrac REAL,
+    period REAL,
+    PRIMARY KEY (file, block)
+) WITHOUT ROWID;
+'''
+
+
+class ResultStore:
+    """Block results of analyzeFile in a SQLite database.
+
+    Every file is stored with its folder, which is its condition in the
+    statistics, its name and params, the analysis.settingsKey of the
+    settings of its analysis, so that results of different analyses of the
+    same images are kept apart. Blocks are numbered like the results of
+    analyzeFile flattened, and results that are nan are stored as NULL.
+
+    Use it as a context manager, or close() it, to close the database."""
+
+    # Columns of the blocks and the analyzeFile results they come from
+    columns = {'corr': 'localCorr', 'theta': 'localTheta',
+               'phase': 'localPhase', 'th0': 'localTh0', 'maxZ': 'localMaxZ',
+               'neuronFrac': 'localNeuronFrac', 'period': 'localPeriod'}
+
+    def __init__(self, filename):
+
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        self.connection.execute('PRAGMA synchronous = NORMAL')
+        self.connection.executescript(schema)
+
+    def addFile(self, folder, name, params, result):
+        """Stores the analyzeFile results of the file name of folder, and
+        replaces the ones of a previous analysis with the same params."""
+
+        values = []
+        for key in self.columns.values():
+            if result.get(key) is None:
+                values.append(itertools.repeat(None))
+            else:
+                values.append(np.ravel(result[key]).astype(float).tolist())
+
+        with self.connection:
+            cursor = self.connection.execute(
+                'SELECT id FROM files WHERE params = ? AND folder = ? AND '
+                'name = ?', (params, folder, name))
+            row = cursor.fetchone()
+            if row is None:
+                fileId = self.connection.execute(
+                    'INSERT INTO files (folder, name, params) '
+                    'VALUES (?, ?, ?)', (folder, name, params)).lastrowid
+            else:
+                fileId = row[0]
+                self.connection.execute('DELETE FROM blocks WHERE file = ?',
+                                        (fileId, ))
+
+            nblocks = np.size(result['localCorr'])
+            rows = zip(itertools.repeat(fileId), range(nblocks), *values)
+            self.connection.executemany(
+                'INSERT INTO blocks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def files(self, params=None):
+        """(id, folder, name, params) of the stored files, of all the
+        analyses or only of the ones with params."""
+
+        query = 'SELECT id, folder, name, params FROM files'
+        args = ()
+        if params is not None:
+            query += ' WHERE params = ?'
+            args = (params, )
+        return self.connection.execute(query + ' ORDER BY id', args).fetchall()
+
+    def blocks(self, columns=('corr', ), folder=None, params=None):
+        """Results of the blocks with a correlation, of all the files or
+        only of the ones of folder and params.
+
+        returns:
+
+        ids of the files of the blocks and an array for every column"""
+
+        for column in columns:
+            if column not in self.columns:
+                raise ValueError('Unknown column ' + column)
+
+        condition, args = self._fileCondition(folder, params)
+        query = ('SELECT file' + ''.join(', ' + c for c in columns) +
+                 ' FROM blocks WHERE corr IS NOT NULL' + condition +
+                 ' ORDER BY file, block')
+        rows = self.connection.execute(query, args).fetchall()
+
+        table = np.array(rows, dtype=float).reshape(len(rows),
+                                                    len(columns) + 1)
+        return (table[:, 0].astype(int), ) + tuple(table[:, 1:].T)
+
+    def ringFractions(self, corrThres, folder=None, params=None):
+        """Fraction of the blocks with a correlation over corrThres in every
+        folder, with the binomial std of the fractions as in batch.
+
+        returns:
+
+        list of (folder, files, n, nrings, ringFrac, ringFracStd), where n
+        is the number of blocks with a correlation"""
+
+        # Blocks are counted by file first, in the order of the table, and
+        # the counts of the files are then added by folder
+        condition, args = self._fileCondition(folder, params)
+        query = ('SELECT f.folder, COUNT(*), SUM(c.n), TOTAL(c.nrings) FROM'
+                 ' (SELECT file, COUNT(corr) AS n, TOTAL(corr > ?) AS nrings'
+                 ' FROM blocks WHERE corr IS NOT NULL' + condition +
+                 ' GROUP BY file) AS c JOIN files AS f ON c.file = f.id'
+                 ' GROUP BY f.folder ORDER BY f.folder')
+        args = (corrThres, ) + args
+
+        fractions = []
+        for folder, nfiles, n, nrings in self.connection.execute(query, args):
+            ringFrac = nrings/n
+            fracStd = float(aggregate.binomialStd(ringFrac, n))
+            fractions.append((folder, nfiles, n, int(nrings), ringFrac,
+                              fracStd))
+        return fractions
+
+    def stats(self, corrThres, folder=None, params=None):
+        """Ring statistics of every folder as in batch, see
+        aggregate.groupStats, from the blocks of all the files or only of
+        the ones of folder and params.
+
+        returns:
+
+        folders: names of the folders
+        stats: dict of aggregate.groupStats with a value for every folder"""
+
+        where, args = self._fileWhere(folder, params)
+        files = self.connection.execute(
+            'SELECT id, folder FROM files' + where + ' ORDER BY id',
+            args).fetchall()
+        fileIds = np.array([f[0] for f in files], dtype=int)
+        folders, groups = np.unique([f[1] for f in files],
+                                    return_inverse=True)
+
+        # Index of the file of every block in the sorted ids of the files
+        ids, corr = self.blocks(('corr', ), folder, params)
+        blockFiles = np.searchsorted(fileIds, ids)
+        corrMoments, ringMoments = aggregate.fileStats(
+            corr, blockFiles, len(files), corrThres)
+        stats = aggregate.groupStats(corrMoments, ringMoments, groups,
+                                     len(folders))
+        return list(folders), stats
+
+    def _fileWhere(self, folder, params):
+        conditions = []
+        args = ()
+        if folder is not None:
+            conditions.append('folder = ?')
+            args += (folder, )
+        if params is not None:
+            conditions.append('params = ?')
+            args += (params, )
+        if not conditions:
+            return '', args
+        return ' WHERE ' + ' AND '.join(conditions), args
+
+    def _fileCondition(self, folder, params):
+        where, args = self._fileWhere(folder, params)
+        if not where:
+            return '', args
+        return ' AND file IN (SELECT id FROM files' + where + ')', args
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
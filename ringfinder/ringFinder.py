@@ -7,11 +7,8 @@ Created on Fri Jul 15 12:25:40 2016
 
 import os
 import time
-import math
 import numpy as np
 from scipy import ndimage as ndi
-import tifffile as tiff
-from PIL import Image
 
 import pyqtgraph as pg
 from pyqtgraph.Qt import QtGui, QtCore
@@ -22,6 +19,8 @@ import matplotlib.colors
 
 import ringfinder.utils as utils
 import ringfinder.tools as tools
+import ringfinder.analysis as analysis
+import ringfinder.sharedmem as sharedmem
 import ringfinder.pyqtsubclass as pyqtsub
 
 # rc('text', usetex=True)
@@ -35,6 +34,8 @@ class Gollum(QtGui.QMainWindow):
 
         self.i = 0
         self.testData = False
+        self.pool = None
+        self.blockCache = tools.BlockCache()
 
         self.setWindowTitle('Gollum: the Ring Finder')
 
@@ -119,8 +120,12 @@ class Gollum(QtGui.QMainWindow):
         self.corrSlider.setValue(200)
         self.corrThresEdit = QtGui.QLineEdit()
         self.minAreaEdit = QtGui.QLineEdit()
+        self.periodSweepEdit = QtGui.QLineEdit()
+        self.precisionEdit = QtGui.QLineEdit()
+        self.workersEdit = QtGui.QLineEdit()
         self.corrSlider.valueChanged[int].connect(self.sliderChange)
         self.showCorrMapCheck = QtGui.QCheckBox('Show coefficient map', self)
+        self.denseCheck = QtGui.QCheckBox('Dense map', self)
         self.thetaStepEdit = QtGui.QLineEdit()
         self.deltaThEdit = QtGui.QLineEdit()
         self.sinPowerEdit = QtGui.QLineEdit()
@@ -131,6 +136,8 @@ class Gollum(QtGui.QMainWindow):
         settingsTitle.setTextFormat(QtCore.Qt.RichText)
         settingsTitle.setAlignment(QtCore.Qt.AlignCenter)
         settingsTitle.setStyleSheet("font-size:14px")
+        sigmaLabel = QtGui.QLabel('Sigma of gaussian filter [nm]')
+        minAreaLabel = QtGui.QLabel('Area threshold [%]')
         wvlenLabel = QtGui.QLabel('Rings periodicity [nm]')
         self.wvlenEdit = QtGui.QLineEdit()
         corrThresLabel = QtGui.QLabel('Discrimination threshold')
@@ -153,6 +160,9 @@ class Gollum(QtGui.QMainWindow):
         self.thetaStepEdit.editingFinished.connect(self.updateConfig)
         self.deltaThEdit.editingFinished.connect(self.updateConfig)
         self.corrThresEdit.editingFinished.connect(self.updateConfig)
+        self.periodSweepEdit.editingFinished.connect(self.updateConfig)
+        self.precisionEdit.editingFinished.connect(self.updateConfig)
+        self.workersEdit.editingFinished.connect(self.updateConfig)
 
         self.buttonWidget = QtGui.QWidget()
         buttonsLayout = QtGui.QGridLayout()
@@ -171,13 +181,20 @@ class Gollum(QtGui.QMainWindow):
         buttonsLayout.addWidget(self.loadSTEDButton, 3, 2)
 
         buttonsLayout.addWidget(settingsTitle, 5, 0, 1, 3)
-        buttonsLayout.addWidget(wvlenLabel, 6, 0, 1, 2)
-        buttonsLayout.addWidget(self.wvlenEdit, 6, 2)
-        buttonsLayout.addWidget(corrThresLabel, 7, 0, 1, 2)
-        buttonsLayout.addWidget(self.corrThresEdit, 7, 2)
-        buttonsLayout.addWidget(self.corrSlider, 8, 0, 1, 3)
-        buttonsLayout.addWidget(self.showCorrMapCheck, 9, 0, 1, 3)
-        buttonsLayout.addWidget(self.corrButton, 10, 0, 1, 3)
+        buttonsLayout.addWidget(sigmaLabel, 6, 0, 1, 2)
+        buttonsLayout.addWidget(self.sigmaEdit, 6, 2)
+        buttonsLayout.addWidget(self.intThrLabel, 7, 0, 1, 2)
+        buttonsLayout.addWidget(self.intThresEdit, 7, 2)
+        buttonsLayout.addWidget(minAreaLabel, 8, 0, 1, 2)
+        buttonsLayout.addWidget(self.minAreaEdit, 8, 2)
+        buttonsLayout.addWidget(wvlenLabel, 9, 0, 1, 2)
+        buttonsLayout.addWidget(self.wvlenEdit, 9, 2)
+        buttonsLayout.addWidget(corrThresLabel, 10, 0, 1, 2)
+        buttonsLayout.addWidget(self.corrThresEdit, 10, 2)
+        buttonsLayout.addWidget(self.corrSlider, 11, 0, 1, 3)
+        buttonsLayout.addWidget(self.showCorrMapCheck, 12, 0, 1, 2)
+        buttonsLayout.addWidget(self.denseCheck, 12, 2)
+        buttonsLayout.addWidget(self.corrButton, 13, 0, 1, 3)
         buttonsLayout.setRowMinimumHeight(4, 20)
         buttonsLayout.setColumnMinimumWidth(0, 140)
         self.buttonWidget.setFixedWidth(270)
@@ -197,9 +214,19 @@ class Gollum(QtGui.QMainWindow):
 
         self.loadSTORMButton.clicked.connect(self.loadSTORM)
         self.loadSTEDButton.clicked.connect(self.loadSTED)
-        self.sigmaEdit.textChanged.connect(self.updateMasks)
         self.corrButton.clicked.connect(self.ringFinder)
 
+        # Pipeline stages from which the parameters of this window change
+        # the results, the others are only set in the config file
+        stages = {'filter': (self.sigmaEdit, ),
+                  'mask': (self.intThresEdit, ),
+                  'blocks': (self.minAreaEdit, self.wvlenEdit),
+                  'display': (self.corrThresEdit, )}
+        for stage, edits in stages.items():
+            for edit in edits:
+                edit.editingFinished.connect(
+                    lambda stage=stage: self.updateStage(stage))
+
         # Load sample STED image
         folder = os.path.join(os.getcwd(), 'ringfinder')
         if os.path.exists(folder):
@@ -212,6 +239,25 @@ class Gollum(QtGui.QMainWindow):
     def updateConfig(self):
         tools.saveConfig(self)
 
+    def updateStage(self, stage):
+        """Updates the results after a parameter change, from the pipeline
+        stage that it affects: 'filter' for the gaussian filter, 'mask' for
+        the intensity threshold, 'blocks' for the block analysis and
+        'display' for the discrimination threshold. The image is only
+        filtered again if sigma changed, and blocks whose data, mask and
+        analysis parameters did not change are taken from the block
+        cache."""
+
+        if stage == 'display':
+            if self.analyzed:
+                self.corrEditChange(self.corrThresEdit.text())
+            return
+
+        if stage in ('filter', 'mask'):
+            self.updateMasks()
+        if self.analyzed and self.corrButton.isChecked():
+            self.ringFinder()
+
     def sliderChange(self, value):
         self.corrThresEdit.setText(str(np.round(0.001*value, 2)))
         self.corrEditChange(str(value/1000))
@@ -263,28 +309,29 @@ class Gollum(QtGui.QMainWindow):
                 self.ringVb.clear()
                 self.ringResult.clear()
 
-                im = Image.open(self.filename)
-                self.inputData = np.array(im).astype(np.float64)
-                self.initShape = self.inputData.shape
+                self.initShape = tools.imageShape(self.filename)
                 bound = (np.array(self.initShape) - self.crop).astype(np.int)
-                self.inputData = self.inputData[self.crop:bound[0],
-                                                self.crop:bound[1]]
-                self.shape = self.inputData.shape
+                self.shape = tuple(bound - self.crop)
 
                 # We need 1um n-sized subimages
                 self.subimgPxSize = int(1000/self.pxSize)
                 self.n = (np.array(self.shape)/self.subimgPxSize).astype(int)
 
-                # If n*subimgPxSize < shape, we crop the image
+                # If n*subimgPxSize < shape, we crop the image. Only the
+                # cropped region is read from the file.
                 self.remanent = np.array(self.shape) - self.n*self.subimgPxSize
-                self.inputData = self.inputData[:self.n[0]*self.subimgPxSize,
-                                                :self.n[1]*self.subimgPxSize]
+                edge = self.crop + self.n*self.subimgPxSize
+                region = (slice(self.crop, edge[0]), slice(self.crop, edge[1]))
+                self.inputData = tools.loadData(self.filename,
+                                                self.precisionEdit.text(),
+                                                region)
                 self.shape = self.inputData.shape
 
                 self.nblocks = np.array(self.inputData.shape)/self.n
                 self.blocksInput = tools.blockshaped(self.inputData,
                                                      *self.nblocks)
 
+                self.filteredSigma = None
                 self.updateMasks()
                 self.corrVb.addItem(self.corrImgItem)
                 self.ringVb.addItem(self.ringImgItem)
@@ -324,7 +371,9 @@ class Gollum(QtGui.QMainWindow):
         thr = np.float(self.intThresEdit.text())
 
         if self.testData:
-            self.blocksInputS = [ndi.gaussian_filter(b, self.gaussSigma)
+            dtype = tools.floatType(self.inputData)
+            self.blocksInputS = [ndi.gaussian_filter(b, self.gaussSigma,
+                                                     output=dtype)
                                  for b in self.blocksInput]
             self.blocksInputS = np.array(self.blocksInputS)
             self.meanS = np.mean(self.blocksInputS, (1, 2))
@@ -338,13 +387,18 @@ class Gollum(QtGui.QMainWindow):
             self.mask = tools.unblockshaped(mask, *self.inputData.shape)
             self.inputDataS = tools.unblockshaped(self.blocksInputS,
                                                   *self.shape)
+            self.filteredSigma = None
         else:
-            self.inputDataS = ndi.gaussian_filter(self.inputData,
-                                                  self.gaussSigma)
-            self.blocksInputS = tools.blockshaped(self.inputDataS,
-                                                  *self.nblocks)
-            self.meanS = np.mean(self.inputDataS)
-            self.stdS = np.std(self.inputDataS)
+            # The image is only filtered again if sigma changed
+            if self.gaussSigma != self.filteredSigma:
+                self.inputDataS = ndi.gaussian_filter(
+                    self.inputData, self.gaussSigma,
+                    output=tools.floatType(self.inputData))
+                self.blocksInputS = tools.blockshaped(self.inputDataS,
+                                                      *self.nblocks)
+                self.meanS = np.mean(self.inputDataS)
+                self.stdS = np.std(self.inputDataS)
+                self.filteredSigma = self.gaussSigma
             self.mask = self.inputDataS < self.meanS + thr*self.stdS
             self.blocksMask = tools.blockshaped(self.mask, *self.nblocks)
 
@@ -370,31 +424,55 @@ class Gollum(QtGui.QMainWindow):
             sinPow = np.float(self.sinPowerEdit.text())
             cArgs = minLen, thetaStep, deltaTh, wvlen, sinPow
 
-            # Single-core code
-            self.localCorr = np.zeros(len(self.blocksInput))
             thres = self.meanS + intThr*self.stdS
-            if not(self.testData):
-                thres = thres*np.ones(self.blocksInput.shape)
-
-            for i in np.arange(len(self.blocksInput)):
-                block = self.blocksInput[i]
-                blockS = self.blocksInputS[i]
-                mask = self.blocksMask[i]
-                # Block may be excluded from the analysis for two reasons.
-                # Firstly, because the intensity for all its pixels may be
-                # too low. Secondly, because the part of the block that
-                # belongs toa neuron may be below an arbitrary 20% of the
-                # block. We apply intensity threshold to smoothed data so we
-                # don't catch tiny bright spots outside neurons
-                neuronFrac = 1 - np.sum(mask)/np.size(mask)
-                areaThres = 0.01*float(self.minAreaEdit.text())
-                if np.any(blockS > thres[i]) and neuronFrac > areaThres:
-                    output = tools.corrMethod(block, mask, *cArgs)
-                    angle, corrTheta, corrMax, theta, phase = output
-                    # Store results
-                    self.localCorr[i] = corrMax
+            areaThres = 0.01*float(self.minAreaEdit.text())
+
+            # The dense map needs the intensity threshold of the whole
+            # image, test data has one for every block
+            dense = self.denseCheck.isChecked() and not self.testData
+            if dense and not batch:
+                # Windows of the size of the blocks, every tenth of a block
+                stride = max(1, self.subimgPxSize//10)
+                output = tools.denseCorr(self.inputData, self.inputDataS,
+                                         self.mask, self.subimgPxSize, thres,
+                                         areaThres, *cArgs[1:], stride=stride)
+                self.denseCorr = output[1]
+                localCorrBig = tools.denseImage(self.denseCorr, self.shape,
+                                                self.subimgPxSize, stride)
+                self.updateGUI(None, localCorrBig)
+                return
+
+            # Optional ring period estimation for every block
+            wvlens = tools.periodSweep(self.periodSweepEdit.text())
+            if wvlens is None:
+                pool = self.blockPool()
+                if pool is None:
+                    output = tools.corrBlocks(self.blocksInput,
+                                              self.blocksInputS,
+                                              self.blocksMask, thres,
+                                              areaThres, *cArgs,
+                                              cache=self.blockCache)
                 else:
-                    self.localCorr[i] = np.nan
+                    # Workers read their blocks from shared memory
+                    size = self.subimgPxSize
+                    with sharedmem.SharedBlocks.create(
+                            self.inputData, self.inputDataS, self.mask, size,
+                            size) as shared:
+                        output = tools.corrBlocks(self.blocksInput,
+                                                  self.blocksInputS,
+                                                  self.blocksMask, thres,
+                                                  areaThres, *cArgs,
+                                                  pool=pool, shared=shared,
+                                                  cache=self.blockCache)
+            else:
+                # Gollum shows the correlation at the best period, the period
+                # maps are saved by batch
+                output = tools.periodBlocks(self.blocksInput,
+                                            self.blocksInputS,
+                                            self.blocksMask, thres, areaThres,
+                                            minLen, thetaStep, deltaTh,
+                                            wvlens/self.pxSize, sinPow)
+            self.localCorr = output[1]
 
             self.localCorr = self.localCorr.reshape(*self.n)
             self.updateGUI(self.localCorr)
@@ -403,15 +481,62 @@ class Gollum(QtGui.QMainWindow):
             self.corrResult.clear()
             self.ringResult.clear()
 
-    def updateGUI(self, localCorr):
+    def analysisSettings(self):
+        """Settings of the loaded image and of the analysis, as needed by
+        analysis.analyzeFile."""
+
+        return {'pxSize': self.pxSize, 'crop': self.crop,
+                'sigma': float(self.sigmaEdit.text()),
+                'intThres': float(self.intThresEdit.text()),
+                'minLen': float(self.lineLengthEdit.text()),
+                'thStep': float(self.thetaStepEdit.text()),
+                'deltaTh': float(self.deltaThEdit.text()),
+                'wvlen': float(self.wvlenEdit.text()),
+                'sinPow': float(self.sinPowerEdit.text()),
+                'minArea': float(self.minAreaEdit.text()),
+                'periodSweep': self.periodSweepEdit.text(),
+                'corrThres': float(self.corrThresEdit.text()),
+                'precision': self.precisionEdit.text(), 'engine': 'batch'}
+
+    def blockPool(self):
+        """Pool of worker processes for the analysis of single images and
+        batches, kept between runs, or None to run it in this process."""
+
+        workers = int(self.workersEdit.text())
+        if workers <= 1:
+            return None
+
+        if self.pool is None or self.poolWorkers != workers:
+            if self.pool is not None:
+                self.pool.shutdown()
+            self.pool = tools.processPool(workers)
+            self.poolWorkers = workers
+
+        return self.pool
+
+    def closeEvent(self, *args, **kwargs):
+        """Stops the worker processes of blockPool with the window. Shared
+        memory of the analysis is freed when each analysis ends."""
+
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+        super().closeEvent(*args, **kwargs)
+
+    def updateGUI(self, localCorr, localCorrBig=None):
+        """Shows the block results in localCorr or, if given, the full
+        resolution map localCorrBig of a dense analysis."""
 
         self.analyzed = True
         self.localCorr = localCorr
 
         # code for visualization of the output
-        mag = np.array(self.inputData.shape)/self.n
-        self.localCorrBig = np.repeat(self.localCorr, mag[0], 0)
-        self.localCorrBig = np.repeat(self.localCorrBig, mag[1], 1)
+        if localCorrBig is None:
+            mag = np.array(self.inputData.shape)/self.n
+            self.localCorrBig = np.repeat(self.localCorr, mag[0], 0)
+            self.localCorrBig = np.repeat(self.localCorrBig, mag[1], 1)
+        else:
+            self.localCorrBig = localCorrBig
         showIm = 100*np.fliplr(np.transpose(self.localCorrBig))
         self.corrResult.setImage(np.nan_to_num(showIm))
         self.corrResult.setZValue(10)    # make sure this image is on top
@@ -424,7 +549,7 @@ class Gollum(QtGui.QMainWindow):
         self.ringResult.setZValue(10)    # make sure this image is on top
         self.ringResult.setOpacity(0.5)
 
-        if self.showCorrMapCheck.isChecked():
+        if self.showCorrMapCheck.isChecked() and localCorr is not None:
             plt.figure(figsize=(10, 8))
             data = self.localCorr.reshape(*self.n)
             data = np.flipud(data)
@@ -454,139 +579,28 @@ class Gollum(QtGui.QMainWindow):
             filenames = utils.getFilenames('Load ' + tech + ' images',
                                            [('Tiff file', '*.tif;*.tiff')],
                                            self.folder)
-            nfiles = len(filenames)
             function(filenames[0])
-            corrArray = np.zeros((nfiles, self.n[0], self.n[1]))
-
-            # Expand correlation array so it matches data shape
-            corrExp = np.empty((nfiles, self.initShape[0], self.initShape[1]),
-                               dtype=np.single)
-            corrExp[:] = np.nan
-            ringsExp = np.empty((nfiles, self.initShape[0], self.initShape[1]),
-                                dtype=np.single)
-            ringsExp[:] = np.nan
 
             path = os.path.split(filenames[0])[0]
-            folder = os.path.split(path)[1]
             self.folderStatus.setText('Processing folder ' + path)
-            print('Processing folder', path)
             t0 = time.time()
 
-            # Make results directory if it doesn't exist
-            resultsDir = os.path.join(path, 'results')
-            if not os.path.exists(resultsDir):
-                os.makedirs(resultsDir)
-            resNames = [utils.insertFolder(p, 'results') for p in filenames]
-
-            for i in np.arange(nfiles):
-                print(os.path.split(filenames[i])[1])
-                self.fileStatus.setText(os.path.split(filenames[i])[1])
-                function(filenames[i])
-                self.ringFinder(False, batch=True)
-                corrArray[i] = self.localCorr
-
-                bound = (np.array(self.initShape) - self.crop).astype(np.int)
-                edge = bound - self.remanent
-                corrExp[i, self.crop:edge[0],
-                        self.crop:edge[1]] = self.localCorrBig
-
-                # Save correlation values array
-                corrName = utils.insertSuffix(resNames[i], '_correlation')
-                tiff.imsave(corrName, corrExp[i], software='Gollum',
-                            imagej=True,
-                            resolution=(1000/self.pxSize, 1000/self.pxSize),
-                            metadata={'spacing': 1, 'unit': 'um'})
-
-            # Saving ring images
-            ringsExp[corrExp < self.corrThres] = 0
-            ringsExp[corrExp >= self.corrThres] = 1
-            for i in np.arange(nfiles):
-                # Save correlation values array
-                ringName = utils.insertSuffix(resNames[i], '_rings')
-                tiff.imsave(ringName, ringsExp[i], software='Gollum',
-                            imagej=True,
-                            resolution=(1000/self.pxSize, 1000/self.pxSize),
-                            metadata={'spacing': 1, 'unit': 'um'})
+            self.corrThres = float(self.corrThresEdit.text())
+            blocksName, summary = analysis.batch(
+                filenames, self.analysisSettings(), self.blockPool(),
+                self.fileStatus.setText)
 
             # save configuration file in the results folder
+            resultsDir = os.path.split(blocksName)[0]
             tools.saveConfig(self, os.path.join(resultsDir, 'config'))
 
-            # plot histogram of the correlation values
-            hrange = (np.min(np.nan_to_num(corrArray)),
-                      np.max(np.nan_to_num(corrArray)))
-            y, x, _ = plt.hist(corrArray.flatten(), bins=20, range=hrange)
-            x = (x[1:] + x[:-1])/2
-
-            # Save data array as txt
-            corrArrayFlat = corrArray.flatten()
-            validCorr = corrArrayFlat[~np.isnan(corrArrayFlat)]
-            validArr = np.repeat(np.arange(nfiles), np.prod(self.n))
-            validArr = validArr[~np.isnan(corrArrayFlat)]
-            valuesTxt = os.path.join(resultsDir, folder + 'corr_values.txt')
-            corrByN = np.stack((validCorr, validArr), 1)
-            np.savetxt(valuesTxt, corrByN, fmt='%f\t%i')
-
-            groupedCorr = [validCorr[np.where(validArr == i)]
-                           for i in np.arange(nfiles)]
-            groupedCorr = [x for x in groupedCorr if len(x) > 0]
-            nfiles = len(groupedCorr)
-            meanCorrs = [np.mean(d) for d in groupedCorr]
-
-            validCorrRing = validCorr[np.where(validCorr > self.corrThres)]
-            validArrRing = validArr[np.where(validCorr > self.corrThres)]
-            groupedCorrRing = [validCorrRing[np.where(validArrRing == i)]
-                               for i in np.arange(nfiles)]
-            ringFracs = [len(groupedCorrRing[i])/len(groupedCorr[i])
-                         for i in np.arange(nfiles)]
-            meanRingCorrs = np.array([np.mean(d) for d in groupedCorrRing])
-            meanRingCorrs = meanRingCorrs[~np.isnan(meanRingCorrs)]
-
-            n = corrArray.size - np.count_nonzero(np.isnan(corrArray))
-            nring = np.sum(validCorr > self.corrThres)
-            validRingCorr = validCorr[validCorr > self.corrThres]
-            ringFrac = nring/n
-
-            # Err estimation: stat err (binomial distribution, p=ringFrac)
-            statVar = ringFrac*(1 - ringFrac)/n
-            fracStd = math.sqrt(statVar)
-
-            statCorrVar = np.var(validCorr)/n
-            corrStd = math.sqrt(statCorrVar)
-
-            statRingCorrVar = np.var(validRingCorr)/nring
-            ringCorrStd = math.sqrt(statRingCorrVar)
-
-            # Plotting
-            plt.style.use('ggplot')
-            plt.figure(figsize=(10, 7.5))
-            plt.bar(x, y, align='center', width=(x[1] - x[0]), color="#3F5D7D")
-            plt.plot((self.corrThres, self.corrThres), (0, np.max(y)), '--',
-                     color='r', linewidth=2)
-            text = ('Pearson coefficient threshold = {0:.2f} \n'
-                    'n = {1}; nrings = {2} \n'
-                    'PSS fraction = {3:.2f} $\pm$ {4:.2f} \n'
-                    'mean coefficient = {5:.3f} $\pm$ {6:.3f}\n'
-                    'mean ring coefficient = {7:.3f} $\pm$ {8:.3f}')
-            text = text.format(self.corrThres, n, nring,
-                               np.mean(ringFracs), fracStd,
-                               np.mean(meanCorrs), corrStd,
-                               np.mean(meanRingCorrs), ringCorrStd)
-            plt.text(0.75*plt.axis()[1], 0.83*plt.axis()[3], text,
-                     horizontalalignment='center', verticalalignment='center',
-                     bbox=dict(facecolor='white'), fontsize=20)
-            plt.xlabel('Pearson correlation coefficient', fontsize=35)
-            plt.tick_params(axis='both', labelsize=25)
-            plt.grid()
-            plt.tight_layout()
-            plt.savefig(os.path.join(resultsDir, folder + 'corr_hist.pdf'),
-                        dpi=300)
-            plt.savefig(os.path.join(resultsDir, folder + 'corr_hist.png'),
-                        dpi=300)
-            plt.close()
+            # Show the results of the last file
+            function(filenames[-1])
+            with np.load(blocksName) as blocks:
+                self.updateGUI(blocks['corr'][-1])
 
             folder = os.path.split(path)[1]
             text = 'Folder ' + folder + ' done in {0:.0f} seconds'
-            print(text.format(time.time() - t0))
             self.folderStatus.setText(text.format(time.time() - t0))
             self.fileStatus.setText('                 ')
 
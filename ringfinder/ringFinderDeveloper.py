@@ -8,12 +8,11 @@ Created on Wed Oct  1 13:41:48 2014
 import os
 import numpy as np
 from scipy import ndimage as ndi
-from PIL import Image
 import pyqtgraph as pg
 from pyqtgraph.Qt import QtCore, QtGui
 
 import ringfinder.utils as utils
-from ringfinder.neurosimulations import simAxon
+from ringfinder.neurosimulations import templateBank
 import ringfinder.tools as tools
 import ringfinder.pyqtsubclass as pyqtsub
 
@@ -336,21 +335,20 @@ class ImageWidget(pg.GraphicsLayoutWidget):
                 self.inputVb.clear()
 
                 # Image loading
-                im = Image.open(self.filename)
-                self.inputData = np.array(im).astype(np.float64)
-                self.shape = self.inputData.shape
-                self.inputData = self.inputData[crop:self.shape[0] - crop,
-                                                crop:self.shape[1] - crop]
-                self.shape = self.inputData.shape
+                self.shape = tools.imageShape(self.filename)
+                self.shape = (self.shape[0] - 2*crop, self.shape[1] - 2*crop)
 
                 # We need 1um n-sized subimages
                 self.subimgPxSize = int(np.round(1000/self.pxSize))
                 self.n = (np.array(self.shape)/self.subimgPxSize).astype(int)
 
-                # If n*subimgPxSize < shape, we crop the image
+                # If n*subimgPxSize < shape, we crop the image. Only the
+                # cropped region is read from the file.
                 self.remanent = np.array(self.shape) - self.n*self.subimgPxSize
-                self.inputData = self.inputData[:self.n[0]*self.subimgPxSize,
-                                                :self.n[1]*self.subimgPxSize]
+                edge = crop + self.n*self.subimgPxSize
+                self.inputData = tools.loadData(
+                    self.filename,
+                    region=(slice(crop, edge[0]), slice(crop, edge[1])))
                 self.shape = self.inputData.shape
 
                 self.nblocks = np.array(self.inputData.shape)/self.n
@@ -500,17 +498,16 @@ class ImageWidget(pg.GraphicsLayoutWidget):
             wvlen = np.float(self.main.wvlenEdit.text()) / self.pxSize
             sinPow = np.float(self.main.sinPowerEdit.text())
             args = [self.selectedMask, minLen, thStep, deltaTh, wvlen, sinPow]
-            output = tools.corrMethod(self.selected, *args, developer=True)
+            output = tools.corrMethod(self.selected, *args, developer=True,
+                                      engine='batch')
             self.th0, corrTheta, corrMax, thetaMax, phaseMax = output
 
             if np.all([self.th0, corrMax]) is not None:
-                self.bestAxon = simAxon(imSize=self.subImgSize, wvlen=wvlen,
-                                        theta=thetaMax, phase=phaseMax,
-                                        b=sinPow).data
-                self.bestAxon = np.ma.array(self.bestAxon,
-                                            mask=self.selectedMask,
-                                            fill_value=0)
-                self.img1.setImage(self.bestAxon.filled(0))
+                self.bestAxon = templateBank.get(self.subImgSize, wvlen,
+                                                 thetaMax, phaseMax, sinPow)
+                self.bestAxon = np.where(self.selectedMask, 0,
+                                         self.bestAxon)
+                self.img1.setImage(self.bestAxon)
                 self.img2.setImage(self.selected)
 
                 shape = self.selected.shape
@@ -12,13 +12,13 @@ import time
 import numpy as np
 from scipy import ndimage as ndi
 import tifffile as tiff
-from PIL import Image
 import matplotlib.pyplot as plt
 import pyqtgraph as pg
 from pyqtgraph.Qt import QtGui, QtCore
 
 import ringfinder.utils as utils
 import ringfinder.tools as tools
+import ringfinder.analysis as analysis
 
 
 class Gollum(QtGui.QMainWindow):
@@ -258,12 +258,11 @@ class Gollum(QtGui.QMainWindow):
                 self.crop = np.int(crop)
                 self.pxSize = pxSize
 
-                im = Image.open(self.filename)
-                self.inputData = np.array(im).astype(np.float64)
-                self.initShape = self.inputData.shape
+                self.initShape = tools.imageShape(self.filename)
                 bound = (np.array(self.initShape) - self.crop).astype(np.int)
-                self.inputData = self.inputData[self.crop:bound[0],
-                                                self.crop:bound[1]]
+                self.inputData = tools.loadData(
+                    self.filename, region=(slice(self.crop, bound[0]),
+                                           slice(self.crop, bound[1])))
                 self.shape = self.inputData.shape
                 self.changeSigma()
 
@@ -334,13 +333,12 @@ class Gollum(QtGui.QMainWindow):
 
             # for each subimg, we apply the correlation method for ring finding
             intThr = np.float(self.intThresEdit.text())
-            corrThres = np.float(self.corrThresEdit.text())
             minLen = np.float(self.lineLengthEdit.text())/self.pxSize
             thetaStep = np.float(self.deltaAngleEdit.text())
             deltaTh = np.float(self.deltaAngleEdit.text())
             wvlen = np.float(self.wvlenEdit.text())/self.pxSize
             sinPow = np.float(self.sinPowerEdit.text())
-            cArgs = corrThres, minLen, thetaStep, deltaTh, wvlen, sinPow
+            cArgs = minLen, thetaStep, deltaTh, wvlen, sinPow
 
             args = self.n, blocksInput, blocksInputS, blocksMask, intThr, cArgs
             self.localCorr = np.zeros(len(blocksInput))
@@ -438,13 +436,12 @@ class Gollum(QtGui.QMainWindow):
 
             intThr = np.float(self.intThresEdit.text())
             gaussSigma = np.float(self.sigmaEdit.text())
-            corrThres = np.float(self.corrThresEdit.text())
             minLen = np.float(self.lineLengthEdit.text())/self.pxSize
             thetaStep = np.float(self.deltaAngleEdit.text())
             deltaTh = np.float(self.deltaAngleEdit.text())
             wvlen = np.float(self.wvlenEdit.text())/self.pxSize
             sinPow = np.float(self.sinPowerEdit.text())
-            cArgs = corrThres, minLen, thetaStep, deltaTh, wvlen, sinPow
+            cArgs = minLen, thetaStep, deltaTh, wvlen, sinPow
 
             self.batchObj = Batch(filenames, pxSize, crop, gaussSigma, intThr,
                                   cArgs)
@@ -600,29 +597,13 @@ class Worker(QtCore.QRunnable):
     def run(self):
 
         self.signals.start.emit()
-        localCorr = np.zeros(len(self.blocksInput))
-
-        # Single-core code
-        for i in np.arange(len(self.blocksInput)):
-            rings = False
-            block = self.blocksInput[i]
-            blockS = self.blocksInputS[i]
-            mask = self.blocksMask[i]
-            # Block may be excluded from the analysis for two reasons.
-            # Firstly, because the intensity for all its pixels may be
-            # too low. Secondly, because the part of the block that
-            # belongs toa neuron may be below an arbitrary 30% of the
-            # block. We apply intensity threshold to smoothed data so we
-            # don't catch tiny bright spots outside neurons
-            neuronFrac = 1 - np.sum(mask)/np.size(mask)
-            thres = self.meanS + self.intThr*self.stdS
-            if np.any(blockS > thres) and neuronFrac > 0.25:
-                output = tools.corrMethod(block, mask, *self.cArgs)
-                angle, corrTheta, corrMax, theta, phase, rings = output
-                # Store results
-                localCorr[i] = corrMax
-            else:
-                localCorr[i] = np.nan
+
+        # Blocks where less than 25% of the area belongs to a neuron are
+        # excluded from the analysis
+        thres = self.meanS + self.intThr*self.stdS
+        output = tools.corrBlocks(self.blocksInput, self.blocksInputS,
+                                  self.blocksMask, thres, 0.25, *self.cArgs)
+        localCorr = output[1]
 
         localCorr = localCorr.reshape(*self.n)
         self.signals.done.emit(localCorr)
@@ -678,12 +659,11 @@ class Batch(QtCore.QObject):
         self.subimgPxSize = 1000/self.pxSize
 
         # Get data shape and derivates
-        im = Image.open(self.files[0])
-        inputData = np.array(im).astype(np.float64)
-        initShape = inputData.shape
-        self.bound = (np.array(inputData.shape) - self.crop).astype(np.int)
-        inputData = inputData[self.crop:self.bound[0], self.crop:self.bound[1]]
-        dataShape = inputData.shape
+        initShape = tools.imageShape(self.files[0])
+        self.bound = (np.array(initShape) - self.crop).astype(np.int)
+        dataShape = tuple(self.bound - self.crop)
+        self.region = (slice(self.crop, self.bound[0]),
+                       slice(self.crop, self.bound[1]))
         self.n = (np.array(dataShape)/self.subimgPxSize).astype(int)
         self.mag = np.array(dataShape)/self.n
         self.corrArray = np.zeros((self.nfiles, self.n[0], self.n[1]))
@@ -716,16 +696,13 @@ class Batch(QtCore.QObject):
     def start(self):
 
         t0 = time.time()
-        for i in np.arange(self.nfiles):
+        # Next images are read while the current one is analyzed
+        images = analysis.prefetch(
+            lambda f: tools.loadData(f, region=self.region), self.files)
+        for i, inputData in enumerate(images):
 
             self.i = i
 
-            # Image loading
-            im = Image.open(self.files[i])
-            inputData = np.array(im).astype(np.float64)
-            inputData = inputData[self.crop:self.bound[0],
-                                  self.crop:self.bound[1]]
-
             inputDataS = ndi.gaussian_filter(inputData, self.gaussSigma)
             meanS = np.mean(inputDataS)
             stdS = np.std(inputDataS)
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Shared memory transport of the analyzed images to worker processes, so that
+blocks are read in place instead of being pickled for every task.
+"""
+
+import numpy as np
+from multiprocessing import shared_memory
+
+
+class SharedBlocks:
+    """Image, smoothed image and mask of an analysis in shared memory.
+
+    The process that creates them with SharedBlocks.create owns the memory
+    and frees it with close(), or by using them as a context manager. Worker
+    processes receive the picklable spec and attach to the same memory by
+    name with SharedBlocks.attach(spec), without any copy.
+
+    Blocks follow the layout of tools.blockshaped: block i is in the block
+    row i // nCols and block column i % nCols of the image. Arrays and views
+    taken from a SharedBlocks must not be used after closing it."""
+
+    names = ('data', 'dataS', 'mask')
+
+    def __init__(self, segments, spec, owner):
+
+        self.spec = spec
+        self.nrows, self.ncols = spec[1], spec[2]
+        self._segments = segments
+        self._owner = owner
+
+        for name, shm, (shmName, shape, dtype) in zip(self.names, segments,
+                                                      spec[0]):
+            setattr(self, name, np.ndarray(shape, dtype, buffer=shm.buf))
+
+    @classmethod
+    def create(cls, data, dataS, mask, nrows, ncols):
+        """Copies data, dataS and mask, whose shapes must be multiples of
+        the (nrows, ncols) block shape, to new shared memory."""
+
+        segments = []
+        arrays = []
+        for arr in (data, dataS, mask):
+            arr = np.asarray(arr)
+            if arr.shape[0] % nrows or arr.shape[1] % ncols:
+                raise ValueError('Arrays must be made of whole blocks')
+
+            shm = shared_memory.SharedMemory(create=True,
+                                             size=max(arr.nbytes, 1))
+            np.ndarray(arr.shape, arr.dtype, buffer=shm.buf)[...] = arr
+            segments.append(shm)
+            arrays.append((shm.name, arr.shape, arr.dtype.str))
+
+        return cls(segments, (tuple(arrays), int(nrows), int(ncols)), True)
+
+    @classmethod
+    def attach(cls, spec):
+        """Attaches to the shared memory described by spec."""
+
+        segments = [shared_memory.SharedMemory(name=name)
+                    for name, shape, dtype in spec[0]]
+        return cls(segments, spec, False)
+
+    def blockView(self, name):
+        """View of the array name ('data', 'dataS' or 'mask') with shape
+        (block rows, nrows, block columns, ncols)."""
+
+        arr = getattr(self, name)
+        return arr.reshape(arr.shape[0]//self.nrows, self.nrows, -1,
+                           self.ncols)
+
+    def blocks(self, name, ix):
+        """(len(ix), nrows, ncols) stack with the blocks of index ix of the
+        array name, like tools.blockshaped(arr, nrows, ncols)[ix]."""
+
+        view = self.blockView(name)
+        ix = np.asarray(ix)
+        return view[ix // view.shape[2], :, ix % view.shape[2], :]
+
+    def close(self):
+        """Detaches from the memory, and frees it if this is its owner."""
+
+        for name in self.names:
+            setattr(self, name, None)
+        for shm in self._segments:
+            shm.close()
+            if self._owner:
+                shm.unlink()
+        self._segments = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -6,10 +6,20 @@ Created on Sun Aug 14 14:53:28 2016
 """
 
 import os
+import hashlib
+import warnings
 import numpy as np
 import math
 import configparser
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+import tifffile as tiff
 from scipy.ndimage.measurements import center_of_mass
+from scipy.ndimage import maximum_filter
+from scipy.fftpack import next_fast_len
+from scipy import optimize
 from skimage.feature import peak_local_max
 try:
     import skimage.filters as filters
@@ -17,7 +27,18 @@ except ImportError:
     import skimage.filter as filters
 from skimage.transform import probabilistic_hough_line
 
-from ringfinder.neurosimulations import simAxon
+from ringfinder.neurosimulations import templateBank, axonHarmonics
+from ringfinder.sharedmem import SharedBlocks
+
+
+# Analysis settings missing in older config files or in some windows, with
+# the widget that holds them and their default value
+optionalSettings = {'Period sweep nm': ('periodSweepEdit', ''),
+                    'Precision': ('precisionEdit', 'float64'),
+                    'Worker processes': ('workersEdit', '1')}
+
+# Precisions of the analysis, see loadData
+precisions = ('float64', 'float32')
 
 
 def saveConfig(main, filename=None):
@@ -44,6 +65,16 @@ def saveConfig(main, filename=None):
         'Discrimination threshold': main.corrThresEdit.text(),
         'Area threshold %': main.minAreaEdit.text()}
 
+    # Settings of widgets that only some windows have are kept from the file
+    current = configparser.ConfigParser()
+    current.read(filename)
+    for key, (widget, default) in optionalSettings.items():
+        if hasattr(main, widget):
+            config['Analysis'][key] = getattr(main, widget).text()
+        else:
+            config['Analysis'][key] = current.get('Analysis', key,
+                                                  fallback=default)
+
     with open(filename, 'w') as configfile:
         config.write(configfile)
 
@@ -64,6 +95,8 @@ def saveDefaultConfig(filename=None):
         'Ring periodicity nm': '180', 'Sinusoidal pattern power': '6',
         'Angular step deg': '3', 'Delta angle deg': '20',
         'Discrimination threshold': '0.2', 'Area threshold %': '20'}
+    for key, (widget, default) in optionalSettings.items():
+        config['Analysis'][key] = default
 
     with open(filename, 'w') as configfile:
         config.write(configfile)
@@ -93,6 +126,149 @@ def loadConfig(main, filename=None):
     main.deltaThEdit.setText(analysisConfig['Delta angle deg'])
     main.corrThresEdit.setText(analysisConfig['Discrimination threshold'])
     main.minAreaEdit.setText(analysisConfig['Area threshold %'])
+    for key, (widget, default) in optionalSettings.items():
+        if hasattr(main, widget):
+            getattr(main, widget).setText(analysisConfig.get(key, default))
+    if hasattr(main, 'precisionEdit'):
+        main.precisionEdit.setText(checkPrecision(main.precisionEdit.text()))
+
+
+def checkPrecision(precision):
+    """precision if it is one of precisions, otherwise 'float64' with a
+    warning, so that a wrong config file does not stop the analysis."""
+
+    if precision in precisions:
+        return precision
+
+    warnings.warn('Unknown precision {!r}, using float64'.format(precision))
+    return 'float64'
+
+
+def periodSweep(text):
+    """Wavelengths of a period sweep given as 'min, max, step', or None if
+    text is empty."""
+
+    if text.strip() == '':
+        return None
+
+    start, stop, step = [float(v) for v in text.split(',')]
+    return np.arange(start, stop + 0.5*step, step)
+
+
+def imageShape(filename):
+    """Shape of the image in a tiff file, read without loading its data."""
+
+    try:
+        with tiff.TiffFile(filename) as tif:
+            return tif.pages[0].shape
+    except ValueError:
+        with Image.open(filename) as image:
+            return image.size[::-1]
+
+
+def readRegion(filename, region=None):
+    """Data of the region (a tuple of slices, the whole image if None) of
+    the first image of a tiff file, decoding as little as possible.
+
+    Uncompressed images are memory-mapped, so only the pages of the file
+    with data of the region are read. Compressed images are read and decoded
+    only in the strips or tiles that overlap the region (see readSegments).
+    Files that tifffile cannot read are decoded completely with PIL."""
+
+    if region is None:
+        region = (slice(None), slice(None))
+
+    try:
+        image = tiff.memmap(filename, page=0, mode='r')
+        data = np.array(image[region])
+        del image
+        return data
+    except ValueError:
+        pass
+
+    try:
+        with tiff.TiffFile(filename) as tif:
+            return readSegments(tif.pages[0], tif.filehandle, region)
+    except ValueError:
+        with Image.open(filename) as image:
+            return np.array(image)[region]
+
+
+def readSegments(page, filehandle, region):
+    """Data of the region (a tuple of two slices) of a tifffile page, read
+    and decoded only from its strips or tiles that overlap the region.
+
+    Pages with several image planes, or whose segments tifffile cannot
+    decode, raise ValueError."""
+
+    separate, depth, height, width, samples = page.shaped
+    if separate != 1 or depth != 1:
+        raise ValueError('Only pages with one image plane are supported')
+
+    rows = range(height)[region[0]]
+    cols = range(width)[region[1]]
+    if len(rows) == 0 or len(cols) == 0:
+        return np.asarray(page.asarray())[region]
+
+    # Bounding box of the region, sliced with its steps at the end
+    top, bottom = min(rows[0], rows[-1]), max(rows[0], rows[-1]) + 1
+    left, right = min(cols[0], cols[-1]), max(cols[0], cols[-1]) + 1
+
+    if page.is_tiled:
+        segLength, segWidth = page.tilelength, page.tilewidth
+    else:
+        segLength, segWidth = page.rowsperstrip, width
+    perRow = -(-width // segWidth)
+    segRows = range(top//segLength, (bottom - 1)//segLength + 1)
+    segCols = range(left//segWidth, (right - 1)//segWidth + 1)
+
+    data = np.zeros((bottom - top, right - left, samples), page.dtype)
+    for index in (r*perRow + c for r in segRows for c in segCols):
+        count = page.databytecounts[index]
+        if count == 0:
+            continue
+        filehandle.seek(page.dataoffsets[index])
+        segment, indices, shape = page.decode(filehandle.read(count), index,
+                                              jpegtables=page.jpegtables)
+        segment = segment.reshape(shape)[0]
+
+        # Overlap of the segment and the bounding box
+        y0, x0 = indices[2], indices[3]
+        y1 = min(y0 + segment.shape[0], bottom, height)
+        x1 = min(x0 + segment.shape[1], right, width)
+        ys, xs = max(y0, top), max(x0, left)
+        data[ys - top:y1 - top, xs - left:x1 - left] = \
+            segment[ys - y0:y1 - y0, xs - x0:x1 - x0]
+
+    if rows.step != 1 or cols.step != 1:
+        data = data[np.subtract(rows, top)][:, np.subtract(cols, left)]
+    if samples == 1:
+        data = data[..., 0]
+    return data
+
+
+def loadData(filename, precision='float64', region=None):
+    """Image data of a tiff file for an analysis with the given precision.
+
+    With 'float64' the data is converted to float64. With 'float32', integer
+    data is kept in its native type, so it takes no extra memory until it is
+    used, and the analysis runs in float32 (see floatType). Other float data
+    is converted to float32.
+
+    region: optional tuple of slices of the image to load (see readRegion),
+    so that cropped parts are neither read nor converted"""
+
+    data = readRegion(filename, region)
+
+    if precision == 'float64':
+        return data.astype(np.float64)
+    elif precision == 'float32':
+        if np.issubdtype(data.dtype, np.integer):
+            return data
+        else:
+            return data.astype(np.float32)
+    else:
+        raise ValueError('Unknown precision ' + str(precision))
 
 
 def pearson(a, b):
@@ -113,6 +289,62 @@ def pearson(a, b):
     return r_out
 
 
+def floatType(data):
+    """Floating point type of the computations with data: float32 for
+    integer and float32 data, float64 for float64 data."""
+
+    return np.result_type(data, np.float32)
+
+
+def maskedMoments(data, mask):
+    """Moments of data over the pixels where mask is False, computed with the
+    mask as a weight vector instead of masked arrays.
+
+    data, mask: 2D block or (n, h, w) stack of blocks
+
+    returns:
+
+    w: (n, h*w) weights, 1 for the unmasked pixels and 0 for the rest
+    dataN: (n, h*w) data minus its mean over the unmasked pixels, 0 at the
+    masked ones
+    dataNorm2: (n, ) sum of dataN**2"""
+
+    mask = np.asarray(mask)
+    w = np.invert(mask).reshape(-1, mask.shape[-2]*mask.shape[-1])
+    w = w.astype(floatType(data))
+    blocks = np.reshape(data, w.shape)
+    nValid = np.sum(w, 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dataN = w*(blocks - (np.sum(w*blocks, 1)/nValid)[:, np.newaxis])
+    dataNorm2 = np.sum(dataN**2, 1)
+
+    return w, dataN, dataNorm2
+
+
+def maskedPearson(data, templates, mask):
+    """2D pearson coefficient of data and templates over the pixels where
+    mask is False. Same value as pearson of the unmasked pixels, computed
+    from their maskedMoments without building masked arrays.
+
+    data, mask: 2D block and its mask
+    templates: 2D template or (n, h, w) stack of templates
+
+    returns:
+
+    coefficient, or array with the n coefficients for a stack"""
+
+    single = np.ndim(templates) == 2
+    w, dataN, dataNorm2 = maskedMoments(data, mask)
+    templates = np.reshape(templates, (-1, ) + np.shape(mask))
+    tempN, tempNorm2 = maskedMoments(
+        templates, np.broadcast_to(mask, templates.shape))[1:]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r = np.dot(tempN, dataN[0])/np.sqrt(tempNorm2*dataNorm2[0])
+
+    return r[0] if single else r
+
+
 def cosTheta(a, b):
     """Angle between two vectors a and b"""
 
@@ -133,8 +365,8 @@ def blockshaped(arr, nrows, ncols):
     each subblock preserving the "physical" layout of arr.
     """
     h, w = arr.shape
-    nrows = np.int(nrows)
-    ncols = np.int(ncols)
+    nrows = int(nrows)
+    ncols = int(ncols)
     return (arr.reshape(h//nrows, nrows, -1, ncols)
                .swapaxes(1, 2)
                .reshape(-1, nrows, ncols))
@@ -225,14 +457,60 @@ def getDirection(data, binary, minLen, debug=False):
             print('No lines were found')
         return None, lines
 
+def tensorDirection(blocksInputS, minCoherence=0.5, res=1):
+    """Returns the direction (angle) of the neurite in every block from the
+    structure tensor of the smoothed data, a deterministic and much cheaper
+    alternative to getDirection.
+
+    The gradient outer products are computed for the whole stack at once and
+    summed over every block. The dominant gradient is perpendicular to the
+    neurite edges, and the coherence of the tensor, (l1 - l2)/(l1 + l2) for
+    its eigenvalues l1 >= l2, measures how well a single direction describes
+    the block (1 for perfectly parallel edges, 0 for isotropic data).
+
+    blocksInputS: (n, h, w) smoothed blocks, as given by blockshaped
+    minCoherence: blocks below this coherence get no direction
+    res: angles are rounded to this resolution in degrees, so that blocks
+        with similar directions share their templates
+
+    returns:
+
+    th0: angles in [0, 180) with the same convention as getDirection, nan
+        for blocks without a clear direction
+    coherence: coherence of every block"""
+
+    gr, gc = np.gradient(np.asarray(blocksInputS), axis=(1, 2))
+    jrr = np.sum(gr*gr, (1, 2))
+    jcc = np.sum(gc*gc, (1, 2))
+    jrc = np.sum(gr*gc, (1, 2))
+
+    return tensorAngle(jrr, jcc, jrc, minCoherence, res)
+
+
+def tensorAngle(jrr, jcc, jrc, minCoherence=0.5, res=1):
+    """Neurite angle and coherence from the summed structure tensor
+    components, see tensorDirection."""
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        coherence = np.sqrt((jrr - jcc)**2 + 4*jrc**2)/(jrr + jcc)
+    coherence = np.nan_to_num(coherence)
+
+    # The neurite runs perpendicular to the dominant gradient
+    phi = 0.5*np.degrees(np.arctan2(2*jrc, jrr - jcc))
+    th0 = (res*np.round((phi + 90)/res)) % 180
+    th0[coherence < minCoherence] = np.nan
+
+    return th0, coherence
+
+
 def linesFromBinary(binaryData, minLen, debug=False):
 
     # find edges
     edges = filters.sobel(binaryData)
 
     # get directions
-    lines = probabilistic_hough_line(edges, threshold=10, line_length=minLen,
-                                     line_gap=3)
+    lines = probabilistic_hough_line(edges, threshold=10,
+                                     line_length=int(minLen), line_gap=3)
 
     if lines == []:
         if debug:
@@ -356,7 +634,8 @@ def fitMethod(data, mask, thres, minLen, thStep, deltaTh, wvlen, sinPow,
 
 
 def corrMethod(data, mask, minLen, thStep, deltaTh, wvlen, sinPow,
-               developer=False):
+               developer=False, bank=None, engine='loop', search='grid',
+               thTol=0.1, th0=None):
     """Searches for rings by correlating the image data with a given
     sinusoidal pattern
 
@@ -369,6 +648,19 @@ def corrMethod(data, mask, minLen, thStep, deltaTh, wvlen, sinPow,
     wvlen: wavelength of the ring pattern, in px
     sinPow: power of the pattern function
     developer (bool): enables additional output of algorithms
+    bank: TemplateBank the simulated axons are taken from. Defaults to the
+    bank shared by the whole session.
+    engine: 'loop' correlates one template at a time, 'batch' evaluates all
+    angles and phases at once (see corrBatch) and 'phasefit' finds the best
+    phase for each angle from a few basis projections (see corrPhaseFit)
+    search: 'grid' takes the best angle of the thStep grid, 'refine' uses
+    the grid as a coarse search and then refines the maximum down to thTol
+    degrees (see refineTheta). With refinement, thStep can be made coarser
+    than the wanted angular resolution.
+    thTol: angular tolerance of the refined search, in degrees
+    th0: direction of the neurite, if it was already estimated (e.g. by
+    tensorDirection). nan means that the block has no clear direction. By
+    default it is found with getDirection.
 
     returns:
 
@@ -378,13 +670,11 @@ def corrMethod(data, mask, minLen, thStep, deltaTh, wvlen, sinPow,
     phaseMax: simulated axon's phase with maximum correlation value at thetaMax
     rings (bool): ring presence"""
 
-    # phase steps are set to 20, TO DO: explore this parameter
-    phase = np.arange(0, 21, 1)
-
-    corrPhase = np.zeros(np.size(phase))
-
     # line angle calculated
-    th0, lines = getDirection(data, np.invert(mask), minLen, developer)
+    if th0 is None:
+        th0, lines = getDirection(data, np.invert(mask), minLen, developer)
+    elif np.isnan(th0):
+        th0 = None
 
     if th0 is None:
 
@@ -411,26 +701,8 @@ def corrMethod(data, mask, minLen, thStep, deltaTh, wvlen, sinPow,
             deltaTh = 90
             theta = np.arange(0, 180, thStep)
 
-        corrPhaseArg = np.zeros(np.size(theta))
-        corrTheta = np.zeros(np.size(theta))
-
-        subImgSize = np.shape(data)[0]
-
-        # for now we correlate with the full sin2D pattern
-        for t in np.arange(len(theta)):
-            for p in phase:
-                # creates simulated axon
-                axonTheta = simAxon(subImgSize, wvlen, theta[t], p*.025, a=0,
-                                    b=sinPow).data
-                axonThetaMasked = np.ma.array(axonTheta, mask=mask)
-                dataMasked = np.ma.array(data, mask=mask)
-
-                # saves correlation for the given phase p
-                corrPhase[p] = pearson(dataMasked, axonThetaMasked)
-
-            # saves the correlation for the best p, and given angle i
-            corrTheta[t - 1] = np.max(corrPhase)
-            corrPhaseArg[t - 1] = .025*np.argmax(corrPhase)
+        corrTheta, corrPhaseArg = corrAngles(data, mask, theta, wvlen,
+                                             sinPow, engine, bank)
 
         # get theta, phase and correlation with greatest correlation value
         # Find indices within (th0 - deltaTh, th0 + deltaTh)
@@ -441,9 +713,957 @@ def corrMethod(data, mask, minLen, thStep, deltaTh, wvlen, sinPow,
         phaseMax = corrPhaseArg[ix][i]
         corrMax = np.max(corrTheta[ix])
 
+        if search == 'refine':
+            bounds = (th0 - deltaTh, th0 + deltaTh)
+            output = refineTheta(data, mask, thetaMax, corrMax, phaseMax,
+                                 thStep, bounds, wvlen, sinPow, thTol,
+                                 engine, bank)
+            thetaMax, corrMax, phaseMax = output
+
     return th0, corrTheta, corrMax, thetaMax, phaseMax
 
 
+def corrAngles(data, mask, theta, wvlen, sinPow, engine='batch', bank=None):
+    """Best correlation over phases for every angle in theta, computed with
+    the given engine (see corrMethod). data and mask may be a single block or
+    a (n, h, w) stack of blocks.
+
+    returns:
+
+    corrTheta: best correlation (over phases) for each angle
+    corrPhaseArg: phase of the best correlation for each angle"""
+
+    # phase steps are set to 20, TO DO: explore this parameter
+    phase = .025*np.arange(0, 21, 1)
+
+    if engine == 'loop':
+        if np.ndim(data) == 2:
+            return corrLoop(data, mask, theta, phase, wvlen, sinPow, bank)
+        else:
+            output = [corrLoop(d, m, theta, phase, wvlen, sinPow, bank)
+                      for d, m in zip(data, mask)]
+            return tuple(np.array(o) for o in zip(*output))
+    elif engine == 'batch':
+        return corrBatch(data, mask, theta, phase, wvlen, sinPow, bank)
+    elif engine == 'phasefit':
+        return corrPhaseFit(data, mask, theta, wvlen, sinPow, bank)
+    else:
+        raise ValueError('Unknown correlation engine ' + str(engine))
+
+
+def refineTheta(data, mask, thetaMax, corrMax, phaseMax, thStep, bounds,
+                wvlen, sinPow, thTol=0.1, engine='batch', bank=None):
+    """Refines an angle of maximum correlation found on a grid of step thStep.
+
+    The maximum is searched within one grid step of thetaMax (and within
+    bounds) with Brent's method, which combines golden-section search and
+    parabolic interpolation, down to a tolerance of thTol degrees. Refined
+    angles are one-off, so their templates are not kept in the bank. With the
+    'batch' engine the correlation is quantized by its phase grid, so the
+    refinement works best with 'phasefit'.
+
+    returns:
+
+    thetaMax, corrMax, phaseMax: refined values, or the input ones if the
+    refinement didn't find a better correlation"""
+
+    if np.isnan(corrMax):
+        return thetaMax, corrMax, phaseMax
+
+    if bank is None:
+        bank = templateBank
+    if engine == 'loop':
+        engine = 'batch'
+
+    lo = max(thetaMax - thStep, bounds[0])
+    hi = min(thetaMax + thStep, bounds[1])
+
+    evaluated = {}
+
+    def negCorr(th):
+        # Templates for one-off angles are built without caching them
+        with bank.bypass():
+            corr, phase = corrAngles(data, mask, [th], wvlen, sinPow, engine,
+                                     bank)
+        evaluated[th] = (corr[0], phase[0])
+        return -np.nan_to_num(corr[0], nan=-np.inf)
+
+    result = optimize.minimize_scalar(negCorr, bounds=(lo, hi),
+                                      method='bounded',
+                                      options={'xatol': thTol})
+    th = result.x
+    if th in evaluated and evaluated[th][0] > corrMax:
+        corrMax, phaseMax = evaluated[th]
+        thetaMax = th
+
+    return thetaMax, corrMax, phaseMax
+
+
+def corrLoop(data, mask, theta, phase, wvlen, sinPow, bank=None):
+    """Correlates data with the pattern for every angle in theta and every
+    phase in phase, one angle at a time with maskedPearson.
+
+    returns:
+
+    corrTheta: best correlation (over phases) for each angle
+    corrPhaseArg: phase of the best correlation for each angle"""
+
+    if bank is None:
+        bank = templateBank
+
+    subImgSize = np.shape(data)[0]
+    corrPhaseArg = np.zeros(np.size(theta))
+    corrTheta = np.zeros(np.size(theta))
+
+    # for now we correlate with the full sin2D pattern
+    for t in np.arange(len(theta)):
+        # simulated axons with every phase
+        axonTheta = [bank.get(subImgSize, wvlen, theta[t], p, sinPow)
+                     for p in phase]
+
+        # saves correlation for every phase
+        corrPhase = maskedPearson(data, axonTheta, mask)
+
+        # saves the correlation for the best p, and given angle t
+        corrTheta[t] = np.max(corrPhase)
+        corrPhaseArg[t] = phase[np.argmax(corrPhase)]
+
+    return corrTheta, corrPhaseArg
+
+
+def corrBatch(data, mask, theta, phase, wvlen, sinPow, bank=None):
+    """Same output as corrLoop, but the correlations with all the
+    len(theta)*len(phase) templates are computed in a single tensor
+    contraction. The data mean and norm over the unmasked pixels are computed
+    once per block instead of once per template.
+
+    data and mask may also be (n, h, w) stacks of blocks to be correlated
+    with the same angles. Outputs are then (n, len(theta)) arrays."""
+
+    if bank is None:
+        bank = templateBank
+
+    single = np.ndim(data) == 2
+    subImgSize = np.shape(data)[-1]
+    dtype = floatType(data)
+    stacks = [bank.stack(subImgSize, wvlen, th, phase, sinPow, dtype)
+              for th in theta]
+    patterns = np.concatenate([st[0] for st in stacks])
+    patterns2 = np.concatenate([st[1] for st in stacks])
+
+    # Unmasked pixels act as weights
+    w, dataN, dataNorm2 = maskedMoments(data, mask)
+    nValid = np.sum(w, 1)
+
+    # Moments of every template over the unmasked pixels of every block
+    patSum = np.dot(patterns, w.T)
+    patNorm2 = np.dot(patterns2, w.T) - patSum**2/nValid
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        corr = np.dot(patterns, dataN.T)/np.sqrt(patNorm2*dataNorm2)
+    corr = corr.reshape(len(theta), len(phase), -1).transpose(2, 0, 1)
+
+    best = np.argmax(corr, 2)
+    corrTheta = np.take_along_axis(corr, best[:, :, np.newaxis], 2)[:, :, 0]
+    corrPhaseArg = np.asarray(phase)[best]
+
+    if single:
+        return corrTheta[0], corrPhaseArg[0]
+    else:
+        return corrTheta, corrPhaseArg
+
+
+def corrPhaseFit(data, mask, theta, wvlen, sinPow, bank=None, nPhase=64):
+    """Correlates data with the pattern for every angle in theta, finding the
+    best phase in [0, 0.5] without a phase grid of templates.
+
+    sin(u + phase)**sinPow is a finite sum of harmonics of u, so for a given
+    angle every pattern is a linear combination of the cos(j*u), sin(j*u)
+    basis images. Projecting the data onto them (and taking their Gram matrix
+    over the unmasked pixels) gives the correlation as a closed-form function
+    of the phase. It is evaluated on nPhase points and the maximum is refined
+    by parabolic interpolation, so the returned phases are continuous.
+
+    Same output as corrLoop. Like in corrBatch, data and mask may also be
+    stacks of blocks."""
+
+    if bank is None:
+        bank = templateBank
+
+    if sinPow != int(sinPow):
+        raise ValueError('Phase fitting needs an integer pattern power')
+
+    single = np.ndim(data) == 2
+    subImgSize = np.shape(data)[-1]
+    harmonics = gramOrders(sinPow)
+    dtype = floatType(data)
+    harm = np.array([bank.basis(subImgSize, wvlen, th, sinPow, harmonics,
+                                dtype) for th in theta])
+
+    corrTheta, corrPhaseArg = phaseFitBasis(maskedMoments(data, mask), harm,
+                                            sinPow, nPhase)
+
+    if single:
+        return corrTheta[0], corrPhaseArg[0]
+    else:
+        return corrTheta, corrPhaseArg
+
+
+def gramOrders(sinPow):
+    """Harmonic orders m > 0 of the products of two images of the basis of
+    axonBasis(..., sinPow), which are all combinations of cos(m*x) and
+    sin(m*x) images."""
+
+    orders = axonHarmonics(sinPow)[0]
+    products = np.concatenate((np.abs(np.subtract.outer(orders, orders)),
+                               np.add.outer(orders, orders)), None)
+    harmonics = np.union1d(orders, products)
+
+    return harmonics[harmonics > 0]
+
+
+def basisGram(cosSum, sinSum, sinPow):
+    """Sums and centered Gram matrix of the basis of axonBasis over the
+    unmasked pixels, from the sums of the harmonics of the grating.
+
+    cosSum, sinSum: (..., 1 + len(gramOrders(sinPow))) arrays with the sums
+    of cos(m*x) and sin(m*x) over the unmasked pixels, first for m = 0 (the
+    number of unmasked pixels and 0) and then for every order of gramOrders
+
+    returns:
+
+    basisSum: (..., nBasis) sums of the basis images
+    gram: (..., nBasis, nBasis) centered Gram matrix"""
+
+    orders = axonHarmonics(sinPow)[0]
+    harmonics = gramOrders(sinPow)
+    pos = np.zeros(harmonics.max() + 1, int)
+    pos[harmonics] = np.arange(1, len(harmonics) + 1)
+
+    # cos(j*x)*cos(k*x) = (cos((j - k)*x) + cos((j + k)*x))/2 and so on
+    diff = pos[np.abs(np.subtract.outer(orders, orders))]
+    total = pos[np.add.outer(orders, orders)]
+    sign = np.sign(np.subtract.outer(orders, orders))
+    cc = 0.5*(cosSum[..., diff] + cosSum[..., total])
+    ss = 0.5*(cosSum[..., diff] - cosSum[..., total])
+    cs = 0.5*(sinSum[..., total] - sign*sinSum[..., diff])
+    gram = np.concatenate((np.concatenate((cc, cs), -1),
+                           np.concatenate((np.swapaxes(cs, -1, -2), ss), -1)),
+                          -2)
+
+    basisSum = np.concatenate((cosSum[..., pos[orders]],
+                               sinSum[..., pos[orders]]), -1)
+    gram -= (basisSum[..., :, np.newaxis]*basisSum[..., np.newaxis, :] /
+             cosSum[..., 0, np.newaxis, np.newaxis])
+
+    return basisSum, gram
+
+
+def phaseFitBasis(moments, harm, sinPow, nPhase=64):
+    """Phase fitting of corrPhaseFit for the blocks with the given
+    maskedMoments.
+
+    harm: (angles, 2*nHarmonics, pixels) array with the cos(m*x) and
+    sin(m*x) images of every pattern angle for the orders of gramOrders, as
+    given by axonBasis
+
+    returns:
+
+    corr, phase: (blocks, angles) arrays"""
+
+    # Unmasked pixels act as weights
+    w, dataN, dataNorm2 = moments
+    nValid = np.sum(w, 1)
+    dataNorm2 = dataNorm2[:, np.newaxis]
+
+    # Sums of the harmonics over the unmasked pixels, with shape
+    # (blocks, angles, harmonics)
+    nAngles, nHarm = len(harm), harm.shape[1]//2
+    sums = np.dot(harm, w.T).transpose(2, 0, 1)
+    nValid = np.broadcast_to(nValid[:, np.newaxis, np.newaxis],
+                             (len(w), nAngles, 1))
+    cosSum = np.concatenate((nValid, sums[..., :nHarm]), -1)
+    sinSum = np.concatenate((np.zeros_like(nValid), sums[..., nHarm:]), -1)
+
+    # Projections and Gram matrix of the basis over the unmasked pixels,
+    # with shapes (blocks, angles, basis) and (blocks, angles, basis, basis)
+    rows = np.searchsorted(gramOrders(sinPow), axonHarmonics(sinPow)[0])
+    basis = harm[:, np.concatenate((rows, rows + nHarm))]
+    proj = np.dot(basis, dataN.T).transpose(2, 0, 1)
+    basisSum, gram = basisGram(cosSum, sinSum, sinPow)
+
+    return phaseFitMax(proj, gram, dataNorm2, sinPow, nPhase)
+
+
+def phaseFitMax(proj, gram, dataNorm2, sinPow, nPhase=64):
+    """Best correlation over the phase of the pattern (see corrPhaseFit),
+    given the projections of the centered data onto the harmonic basis, the
+    centered Gram matrix of the basis and the squared norm of the centered
+    data, all of them over the unmasked pixels.
+
+    proj: (..., nBasis) array
+    gram: (..., nBasis, nBasis) array
+    dataNorm2: (...) array
+
+    returns:
+
+    corr, phase: (...) arrays with the maximum correlation and its phase"""
+
+    orders, alpha, beta = axonHarmonics(sinPow)
+
+    # For even powers the pattern has a period of 0.5 in phase
+    periodic = sinPow % 2 == 0
+    phase = np.linspace(0, .5, nPhase + 1)
+    if periodic:
+        phase = phase[:-1]
+
+    def phaseCoefs(ph):
+        # Coefficients of the pattern with phase ph in the basis
+        psi = 2*np.pi*np.multiply.outer(ph, orders)
+        cos, sin = np.cos(psi), np.sin(psi)
+        return np.concatenate((alpha*cos + beta*sin, beta*cos - alpha*sin),
+                              -1)
+
+    def corr(coefs):
+        # Correlation for the phases given by coefs, which is either
+        # (nPhases, nBasis) or (..., 1, nBasis)
+        num = np.sum(coefs*proj[..., np.newaxis, :], -1)
+        den = np.sum(np.matmul(coefs, gram)*coefs, -1)
+        den *= dataNorm2[..., np.newaxis]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return num/np.sqrt(den)
+
+    corrPhase = corr(phaseCoefs(phase))
+    i = np.argmax(corrPhase, -1)[..., np.newaxis]
+    corrMax = np.take_along_axis(corrPhase, i, -1)
+    phaseMax = phase[i]
+
+    # Parabolic interpolation around the maxima
+    c0 = np.take_along_axis(corrPhase, i - 1, -1)
+    c1 = np.take_along_axis(corrPhase, (i + 1) % len(phase), -1)
+    curv = c0 - 2*corrMax + c1
+    refine = curv < 0
+    if not periodic:
+        refine &= np.logical_and(0 < i, i < len(phase) - 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        newPhase = phaseMax + 0.5*(phase[1] - phase[0])*(c0 - c1)/curv
+    newPhase = np.where(refine, newPhase, phaseMax)
+    newCorr = corr(phaseCoefs(newPhase))
+    better = np.logical_and(refine, newCorr > corrMax)
+    corrMax = np.where(better, newCorr, corrMax)[..., 0]
+    phaseMax = np.where(better, newPhase, phaseMax)[..., 0]
+    if periodic:
+        phaseMax = phaseMax % .5
+
+    return corrMax, phaseMax
+
+
+def blockEligibility(blocksInputS, blocksMask, thres, minArea):
+    """Blocks that go into the correlation analysis.
+
+    A block may be excluded from the analysis for two reasons. Firstly,
+    because the intensity for all its pixels may be too low. Secondly,
+    because the part of the block that belongs to a neuron may be below a
+    minimum fraction of the block. We apply intensity threshold to smoothed
+    data so we don't catch tiny bright spots outside neurons.
+
+    blocksInputS: (n, h, w) smoothed blocks
+    blocksMask: (n, h, w) boolean array, True means background
+    thres: intensity threshold, either a single value or one per block
+    minArea: minimum neuron fraction of the block, in (0, 1)
+
+    returns:
+
+    eligible: boolean array, True for blocks to be analyzed
+    neuronFrac: fraction of every block that belongs to a neuron"""
+
+    maxS = np.max(blocksInputS, (1, 2))
+    neuronFrac = 1 - np.mean(blocksMask, (1, 2))
+    eligible = np.logical_and(maxS > np.ravel(thres), neuronFrac > minArea)
+
+    return eligible, neuronFrac
+
+
+def blockDirections(blocksInput, blocksInputS, blocksMask, eligible, minLen,
+                    direction='hough', minCoherence=0.5, res=1):
+    """Direction of the neurite in every eligible block.
+
+    direction: 'hough' estimates directions block by block with getDirection,
+    'tensor' for all blocks at once with tensorDirection
+    res: angles are rounded to this resolution in degrees, like in
+    tensorDirection, so that blocks with similar directions are correlated
+    together with the same templates
+
+    returns:
+
+    th0: angles of the blocks in [0, 180), nan for blocks that are not
+    eligible or whose direction could not be found"""
+
+    th0 = np.full(len(blocksInput), np.nan)
+
+    if direction == 'hough':
+        for i in np.where(eligible)[0]:
+            angle, lines = getDirection(blocksInput[i],
+                                        np.invert(blocksMask[i]), minLen)
+            if angle is not None:
+                th0[i] = (res*np.round(angle/res)) % 180
+    elif direction == 'tensor':
+        angles, coherence = tensorDirection(blocksInputS, minCoherence, res)
+        th0[eligible] = angles[eligible]
+    else:
+        raise ValueError('Unknown direction method ' + str(direction))
+
+    return th0
+
+
+def corrGroup(data, mask, angle, thStep, deltaTh, wvlen, sinPow,
+              engine='batch', search='grid', thTol=0.1, bank=None):
+    """corrMethod for a (n, h, w) stack of blocks that share their direction
+    angle, as done by corrBlocks.
+
+    returns:
+
+    corrMax, thetaMax, phaseMax: arrays with the result of every block"""
+
+    theta = np.arange(angle - deltaTh, angle + deltaTh, thStep)
+    corrTheta, corrPhaseArg = corrAngles(data, mask, theta, wvlen, sinPow,
+                                         engine, bank)
+
+    # Only angles within (th0 - deltaTh, th0 + deltaTh)
+    inRange = np.logical_and(angle - deltaTh <= theta,
+                             theta <= angle + deltaTh)
+    corrTheta = corrTheta[:, inRange]
+    best = np.argmax(corrTheta, 1)
+    rows = np.arange(len(data))
+    corrMax = corrTheta[rows, best]
+    thetaMax = theta[inRange][best]
+    phaseMax = corrPhaseArg[:, inRange][rows, best]
+
+    if search == 'refine':
+        bounds = (angle - deltaTh, angle + deltaTh)
+        for i in rows:
+            output = refineTheta(data[i], mask[i], thetaMax[i], corrMax[i],
+                                 phaseMax[i], thStep, bounds, wvlen, sinPow,
+                                 thTol, engine, bank)
+            thetaMax[i], corrMax[i], phaseMax[i] = output
+
+    return corrMax, thetaMax, phaseMax
+
+
+def corrGroupShared(spec, ix, angle, *args):
+    """corrGroup for the blocks ix of the data and mask in the shared memory
+    described by spec (see sharedmem.SharedBlocks), run in worker processes.
+    """
+
+    # The blocks of the group are gathered into local copies, so the memory
+    # can be released before correlating them
+    shared = SharedBlocks.attach(spec)
+    try:
+        data = shared.blocks('data', ix)
+        mask = shared.blocks('mask', ix)
+    finally:
+        shared.close()
+
+    return corrGroup(data, mask, angle, *args)
+
+
+def processPool(workers):
+    """Pool of worker processes for corrBlocks. Workers are spawned instead
+    of forked, so the pool can be created from the GUI."""
+
+    return ProcessPoolExecutor(workers,
+                               mp_context=multiprocessing.get_context('spawn'))
+
+
+def corrBlocks(blocksInput, blocksInputS, blocksMask, thres, minArea, minLen,
+               thStep, deltaTh, wvlen, sinPow, engine='batch', bank=None,
+               search='grid', thTol=0.1, direction='hough', minCoherence=0.5,
+               thRes=1, pool=None, shared=None, cache=None):
+    """Applies corrMethod to all the blocks of an image at once.
+
+    Blocks that fail the intensity or area test (see blockEligibility) are
+    dropped up front. The direction of the remaining ones is estimated and
+    rounded to thRes degrees, and then blocks that share their angles to be
+    tested are correlated together in a single contraction. Directions are
+    rounded so that the blocks fall in at most 180/thRes groups, so results
+    differ from the ones of corrMethod by the shift of the angle window.
+
+    blocksInput, blocksInputS, blocksMask: (n, h, w) stacks of data,
+    smoothed data and background mask, as given by blockshaped
+    thres, minArea: see blockEligibility
+    minLen, thStep, deltaTh, wvlen, sinPow, engine, bank, search, thTol: see
+    corrMethod
+    direction: see blockDirections
+    minCoherence: see tensorDirection
+    thRes: resolution of the directions in degrees, see blockDirections
+    pool: optional executor (see processPool) where the groups of blocks
+    are correlated in parallel. Directions are still found here, and every
+    group is correlated exactly as in the serial case, so the results are
+    the same. Workers use their own template bank instead of bank.
+    shared: optional sharedmem.SharedBlocks with the image and mask of the
+    blocks. With a pool, workers read their blocks from it instead of
+    receiving copies of them.
+    cache: optional BlockCache. Eligible blocks whose results are in it are
+    not analyzed again, and the results of the rest are added to it.
+
+    returns:
+
+    th0, corrMax, thetaMax, phaseMax: arrays with the corrMethod results for
+    every block, nan for blocks that were not analyzed or whose direction
+    could not be found"""
+
+    nBlocks = len(blocksInput)
+    corrMax = np.full(nBlocks, np.nan)
+    thetaMax = np.full(nBlocks, np.nan)
+    phaseMax = np.full(nBlocks, np.nan)
+
+    eligible, neuronFrac = blockEligibility(blocksInputS, blocksMask, thres,
+                                            minArea)
+
+    # Only eligible blocks without cached results are analyzed
+    if cache is not None:
+        params = (minLen, thStep, deltaTh, wvlen, sinPow, engine, search,
+                  thTol, direction, minCoherence, thRes)
+        keys = {i: cache.key(blocksInput[i], blocksInputS[i], blocksMask[i],
+                             params) for i in np.where(eligible)[0]}
+        cached = {i: cache.get(key) for i, key in keys.items()}
+        cached = {i: value for i, value in cached.items() if value is not None}
+        eligible = eligible.copy()
+        eligible[list(cached)] = False
+
+    th0 = blockDirections(blocksInput, blocksInputS, blocksMask, eligible,
+                          minLen, direction, minCoherence, thRes)
+
+    # Blocks with the same direction are correlated with the same templates
+    groups = [np.where(th0 == angle)[0]
+              for angle in np.unique(th0[~np.isnan(th0)])]
+    args = (thStep, deltaTh, wvlen, sinPow, engine, search, thTol)
+    if pool is None:
+        results = [corrGroup(blocksInput[ix], blocksMask[ix], th0[ix[0]],
+                             *args, bank=bank) for ix in groups]
+    else:
+        # Largest groups first, so that the workers finish together
+        groups.sort(key=len, reverse=True)
+        if shared is None:
+            futures = [pool.submit(corrGroup, blocksInput[ix], blocksMask[ix],
+                                   th0[ix[0]], *args) for ix in groups]
+        else:
+            futures = [pool.submit(corrGroupShared, shared.spec, ix,
+                                   th0[ix[0]], *args) for ix in groups]
+        results = [future.result() for future in futures]
+
+    for ix, (groupCorr, groupTheta, groupPhase) in zip(groups, results):
+        corrMax[ix] = groupCorr
+        thetaMax[ix] = groupTheta
+        phaseMax[ix] = groupPhase
+
+    if cache is not None:
+        for i in np.where(eligible)[0]:
+            cache.put(keys[i], (th0[i], corrMax[i], thetaMax[i], phaseMax[i]))
+        for i, value in cached.items():
+            th0[i], corrMax[i], thetaMax[i], phaseMax[i] = value
+
+    return th0, corrMax, thetaMax, phaseMax
+
+
+class BlockCache:
+    """Bounded LRU cache of the corrBlocks results of single blocks.
+
+    Results are keyed by the content of the block, its smoothed data and its
+    mask and by the analysis parameters, so when a parameter changes only
+    the blocks that it affects are analyzed again. The cache holds at most
+    maxItems results, evicting the least recently used ones first."""
+
+    def __init__(self, maxItems=2**18):
+
+        self.maxItems = maxItems
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    @staticmethod
+    def key(data, dataS, mask, params):
+        """Key of the results of a block with the given parameters."""
+
+        key = hashlib.blake2b(repr(params).encode(), digest_size=20)
+        for arr in (data, dataS, mask):
+            arr = np.ascontiguousarray(arr)
+            key.update(repr((arr.shape, arr.dtype.str)).encode())
+            key.update(arr)
+
+        return key.digest()
+
+    def get(self, key):
+        """Cached results for key, or None if they are not in the cache."""
+
+        try:
+            value = self._items[key]
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+        except KeyError:
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+
+        self._items[key] = value
+        self._items.move_to_end(key)
+        while len(self._items) > self.maxItems:
+            self._items.popitem(last=False)
+
+
+def angularProfiles(blocksInput, blocksMask, th0, thStep, deltaTh, wvlen,
+                    sinPow, engine='batch', bank=None, chunk=256):
+    """Correlation of every block whose direction was found over a full
+    180 deg sweep of angles around its direction th0, so that the angle
+    window around th0 can be changed later with profileMax without
+    correlating the blocks again.
+
+    Every block is sampled at th0 plus the offsets of the profiles, which
+    start at -deltaTh in steps of thStep like the angles of corrBlocks and
+    are wrapped into [-90, 90). Blocks with the same direction are
+    correlated together, so the profiles hold the correlations of corrBlocks
+    at the angles of its window.
+
+    th0: directions of the blocks as given by corrBlocks, nan for the blocks
+    that were not analyzed
+    thStep, deltaTh, wvlen, sinPow, engine, bank: see corrMethod
+    chunk: number of blocks correlated at once
+
+    returns:
+
+    offsets: increasing angles of the profiles relative to th0
+    corrProfile, phaseProfile: (n, len(offsets)) float32 arrays with the
+    best correlation and its phase at every angle, nan for blocks without a
+    direction"""
+
+    # Offsets from the start of the window of corrBlocks, with the same
+    # arange so that the angles of the window are the same
+    nAngles = len(np.arange(0, 180, thStep))
+    stop = (nAngles - 0.5)*thStep
+    steps = np.arange(-deltaTh, -deltaTh + stop, thStep)
+    wrap = steps >= 90
+    offsets = np.where(wrap, steps - 180, steps)
+    order = np.argsort(offsets, kind='stable')
+    offsets = offsets[order]
+
+    corrProfile = np.full((len(blocksInput), nAngles), np.nan, np.float32)
+    phaseProfile = np.full((len(blocksInput), nAngles), np.nan, np.float32)
+
+    for angle in np.unique(th0[~np.isnan(th0)]):
+        theta = np.arange(angle - deltaTh, angle - deltaTh + stop, thStep)
+        theta = np.where(wrap, theta - 180, theta)[order]
+        group = np.where(th0 == angle)[0]
+        for start in range(0, len(group), chunk):
+            ix = group[start:start + chunk]
+            corrTheta, corrPhaseArg = corrAngles(blocksInput[ix],
+                                                 blocksMask[ix], theta, wvlen,
+                                                 sinPow, engine, bank)
+            corrProfile[ix] = corrTheta
+            phaseProfile[ix] = corrPhaseArg
+
+    return offsets, corrProfile, phaseProfile
+
+
+def profileMax(offsets, corrProfile, phaseProfile, th0, deltaTh):
+    """Best correlation of the angular profiles of angularProfiles in the
+    window of deltaTh around th0 of corrBlocks, that is, at the offsets in
+    [-deltaTh, deltaTh). deltaTh may also be given per block, for other
+    angle acceptance rules. At the deltaTh of the analysis the window has
+    the angles of corrBlocks, so the results are the ones of corrBlocks, up
+    to the float32 precision of the profiles.
+
+    returns:
+
+    corrMax, thetaMax, phaseMax: arrays with the result of every block, nan
+    for blocks without a direction or without angles in their window"""
+
+    th0 = np.asarray(th0, dtype=float)
+    deltaTh = np.asarray(deltaTh, dtype=float)
+    if deltaTh.ndim == 1:
+        deltaTh = deltaTh.reshape(-1, 1)
+
+    inRange = np.logical_and(-deltaTh <= offsets, offsets < deltaTh)
+    corr = np.where(inRange & ~np.isnan(corrProfile), corrProfile, -np.inf)
+    best = np.argmax(corr, 1)
+    rows = np.arange(len(corr))
+    found = np.isfinite(corr[rows, best])
+
+    corrMax = np.where(found, corr[rows, best], np.nan)
+    thetaMax = np.where(found, th0 + offsets[best], np.nan)
+    phaseMax = np.where(found, phaseProfile[rows, best], np.nan)
+
+    return corrMax, thetaMax, phaseMax
+
+
+def periodBlocks(blocksInput, blocksInputS, blocksMask, thres, minArea,
+                 minLen, thStep, deltaTh, wvlens, sinPow, engine='batch',
+                 bank=None, direction='hough', minCoherence=0.5, thRes=1):
+    """Like corrBlocks, but also finds the ring period of every block among
+    the wavelengths in wvlens.
+
+    Eligibility and directions of the blocks are computed once for the whole
+    sweep, and every wavelength is correlated with the given engine, so the
+    correlations are the ones of corrBlocks at each wavelength. With the
+    'phasefit' engine the masked moments of the blocks are also shared, and
+    the patterns of all wavelengths and angles of a group of blocks are
+    correlated in a single contraction (see corrPhaseFit). The period of
+    every block is refined by parabolic interpolation of its correlation
+    between the swept wavelengths.
+
+    wvlens: increasing wavelengths to be tested, in pixels
+    the other arguments are those of corrBlocks
+
+    returns:
+
+    th0, corrMax, thetaMax, phaseMax: like in corrBlocks, for the best
+    wavelength of every block
+    wvlenMax: best wavelength (period) of every block
+    corrWvlen: (blocks, wavelengths) array with the best correlation of
+    every block for each wavelength"""
+
+    if bank is None:
+        bank = templateBank
+
+    wvlens = np.asarray(wvlens, dtype=float)
+    nBlocks = len(blocksInput)
+    nWvlens = len(wvlens)
+    subImgSize = np.shape(blocksInput)[-1]
+    corrMax = np.full(nBlocks, np.nan)
+    thetaMax = np.full(nBlocks, np.nan)
+    phaseMax = np.full(nBlocks, np.nan)
+    wvlenMax = np.full(nBlocks, np.nan)
+    corrWvlen = np.full((nBlocks, nWvlens), np.nan)
+
+    eligible, neuronFrac = blockEligibility(blocksInputS, blocksMask, thres,
+                                            minArea)
+    th0 = blockDirections(blocksInput, blocksInputS, blocksMask, eligible,
+                          minLen, direction, minCoherence, thRes)
+
+    harmonics = gramOrders(sinPow)
+    dtype = floatType(blocksInput)
+    for angle in np.unique(th0[~np.isnan(th0)]):
+        ix = np.where(th0 == angle)[0]
+        theta = np.arange(angle - deltaTh, angle + deltaTh, thStep)
+        nTheta = len(theta)
+
+        if engine == 'phasefit':
+            harm = np.array([bank.basis(subImgSize, wvlen, th, sinPow,
+                                        harmonics, dtype)
+                             for wvlen in wvlens for th in theta])
+            moments = maskedMoments(blocksInput[ix], blocksMask[ix])
+            corr, phase = phaseFitBasis(moments, harm, sinPow)
+            corr = corr.reshape(len(ix), nWvlens, nTheta)
+            phase = phase.reshape(len(ix), nWvlens, nTheta)
+        else:
+            output = [corrAngles(blocksInput[ix], blocksMask[ix], theta,
+                                 wvlen, sinPow, engine, bank)
+                      for wvlen in wvlens]
+            corr = np.stack([o[0] for o in output], 1)
+            phase = np.stack([o[1] for o in output], 1)
+
+        # Best angle for every wavelength, and then best wavelength
+        best = np.argmax(corr, 2)[..., np.newaxis]
+        corrWvlen[ix] = np.take_along_axis(corr, best, 2)[..., 0]
+        bestW = np.argmax(corrWvlen[ix], 1)
+        rows = np.arange(len(ix))
+        corrMax[ix] = corrWvlen[ix, bestW]
+        thetaMax[ix] = theta[best[rows, bestW, 0]]
+        phaseMax[ix] = phase[rows, bestW, best[rows, bestW, 0]]
+        wvlenMax[ix] = wvlens[bestW]
+
+    # Parabolic interpolation of the period between the swept wavelengths
+    if nWvlens > 2:
+        analyzed = np.where(~np.isnan(corrMax))[0]
+        i = np.argmax(corrWvlen[analyzed], 1)
+        inner = np.logical_and(0 < i, i < nWvlens - 1)
+        analyzed, i = analyzed[inner], i[inner]
+        c0 = corrWvlen[analyzed, i - 1]
+        c1 = corrWvlen[analyzed, i]
+        c2 = corrWvlen[analyzed, i + 1]
+        x0, x1, x2 = wvlens[i - 1], wvlens[i], wvlens[i + 1]
+        num = (x1 - x0)**2*(c1 - c2) - (x1 - x2)**2*(c1 - c0)
+        den = (x1 - x0)*(c1 - c2) - (x1 - x2)*(c1 - c0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            vertex = x1 - 0.5*num/den
+        refine = np.logical_and(den != 0,
+                                np.logical_and(x0 < vertex, vertex < x2))
+        wvlenMax[analyzed[refine]] = vertex[refine]
+
+    return th0, corrMax, thetaMax, phaseMax, wvlenMax, corrWvlen
+
+
+def windowSums(arr, h, w):
+    """Sums of arr over every h x w window, from its integral image.
+
+    returns:
+
+    (H - h + 1, W - w + 1) array, indexed by the top-left pixel of the
+    window"""
+
+    integral = np.zeros((arr.shape[0] + 1, arr.shape[1] + 1))
+    integral[1:, 1:] = np.cumsum(np.cumsum(arr, 0), 1)
+    return (integral[h:, w:] - integral[:-h, w:] - integral[h:, :-w] +
+            integral[:-h, :-w])
+
+
+def denseCorr(inputData, inputDataS, mask, subImgSize, thres, minArea,
+              thStep, deltaTh, wvlen, sinPow, stride=1, minCoherence=0.5,
+              bank=None, chunk=4096):
+    """Correlation map from a window of the size of the blocks that slides
+    over the whole image, instead of being evaluated on a fixed grid.
+
+    The masked correlation of every window with every pattern is a masked
+    cross-correlation of the image with the harmonic basis of corrPhaseFit.
+    For each angle, the projections of the data and the Gram matrix of the
+    basis over the unmasked pixels are computed for all windows at once with
+    FFTs, and the window moments from integral images. The phase is then
+    fitted like in corrPhaseFit. The direction of every window comes from its
+    structure tensor (see tensorDirection), rounded to thStep so that windows
+    share their angles, and only the angles within (th0 - deltaTh,
+    th0 + deltaTh) are kept for each window.
+
+    inputData, inputDataS, mask: data, smoothed data and background mask
+    (True means background) of the whole image
+    subImgSize: side of the window in pixels
+    thres, minArea: see blockEligibility
+    thStep, deltaTh, wvlen, sinPow: see corrMethod
+    stride: distance in pixels between evaluated windows
+    minCoherence: see tensorDirection
+    chunk: number of windows whose phase is fitted at once
+
+    returns:
+
+    th0, corrMax, thetaMax, phaseMax: maps with the corrMethod results for
+    the window whose top-left pixel is (i*stride, j*stride), nan for windows
+    that were not analyzed"""
+
+    if bank is None:
+        bank = templateBank
+
+    if sinPow != int(sinPow):
+        raise ValueError('Phase fitting needs an integer pattern power')
+
+    h = w = int(subImgSize)
+    H, W = np.shape(inputData)
+    nRows, nCols = (H - h)//stride + 1, (W - w)//stride + 1
+
+    def subsample(windowMap):
+        return windowMap[:(nRows - 1)*stride + 1:stride,
+                         :(nCols - 1)*stride + 1:stride]
+
+    neuron = np.invert(mask).astype(np.float64)
+    data = neuron*inputData
+
+    # Window moments and eligibility
+    nValid = subsample(windowSums(neuron, h, w))
+    dataSum = subsample(windowSums(data, h, w))
+    dataNorm2 = subsample(windowSums(data*inputData, h, w))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dataNorm2 -= dataSum**2/nValid
+
+    maxS = maximum_filter(inputDataS, size=(h, w))
+    maxS = subsample(maxS[h//2:H - h + 1 + h//2, w//2:W - w + 1 + w//2])
+    eligible = np.logical_and(maxS > thres, nValid/(h*w) > minArea)
+
+    # Direction of every window from its structure tensor
+    gr, gc = np.gradient(np.asarray(inputDataS, np.float64))
+    th0 = tensorAngle(subsample(windowSums(gr*gr, h, w)),
+                      subsample(windowSums(gc*gc, h, w)),
+                      subsample(windowSums(gr*gc, h, w)), minCoherence,
+                      thStep)[0]
+    th0[~eligible] = np.nan
+
+    corrMax = np.full((nRows, nCols), np.nan)
+    thetaMax = np.full((nRows, nCols), np.nan)
+    phaseMax = np.full((nRows, nCols), np.nan)
+
+    # Every window is tested at th0 + offsets, like in corrMethod
+    offsets = np.arange(-deltaTh, deltaTh, thStep)
+    valid = ~np.isnan(th0)
+    windowAngles = np.round(th0[valid][:, np.newaxis] + offsets, 6)
+    if windowAngles.size == 0:
+        return th0, corrMax, thetaMax, phaseMax
+
+    # Products of two basis images are again harmonics of the grating, so
+    # the Gram matrix only needs the mask correlated with a few more orders
+    harmonics = gramOrders(sinPow)
+    nHarm = len(harmonics)
+    rows = np.searchsorted(harmonics, axonHarmonics(sinPow)[0])
+    rows = np.concatenate((rows, rows + nHarm))
+
+    # Zero padding to fast FFT sizes, with rows a multiple of the stride
+    Hp = stride*next_fast_len(-(-H//stride))
+    Wp = next_fast_len(W)
+    fftData = np.fft.rfft2(data, (Hp, Wp))
+    fftNeuron = np.fft.rfft2(neuron, (Hp, Wp))
+
+    def crossCorr(fftImage, kernel, windows):
+        # Only the first h rows of the padded kernel are not zero
+        fftKernel = np.fft.fft(np.fft.rfft(kernel, Wp), Hp, 0)
+        spectrum = np.conj(fftKernel)*fftImage
+        # Only every stride-th row of the result is needed, and those are
+        # the inverse transform of the spectrum folded stride times
+        spectrum = spectrum.reshape(stride, Hp//stride, -1).mean(0)
+        corr = np.fft.irfft(np.fft.ifft(spectrum, axis=0), Wp, 1)
+        return corr[:nRows, :(nCols - 1)*stride + 1:stride][windows]
+
+    for theta in np.unique(windowAngles):
+        sel = np.any(windowAngles == theta, 1)
+        windows = tuple(np.array(np.where(valid))[:, sel])
+        n = nValid[windows]
+
+        # Mask correlated with cos(m*x) and sin(m*x), with m = 0 first
+        harm = bank.basis(h, wvlen, theta, sinPow, harmonics)
+        harm = harm.reshape(2*nHarm, h, w)
+        cosSum = np.array([n] + [crossCorr(fftNeuron, k, windows)
+                                 for k in harm[:nHarm]]).T
+        sinSum = np.array([np.zeros_like(n)] +
+                          [crossCorr(fftNeuron, k, windows)
+                           for k in harm[nHarm:]]).T
+
+        # Centered projections and Gram matrix of the basis over the
+        # unmasked pixels of every window
+        basisSum, gram = basisGram(cosSum, sinSum, sinPow)
+        proj = np.array([crossCorr(fftData, k, windows)
+                         for k in harm[rows]]).T
+        proj -= basisSum*(dataSum[windows]/n)[:, np.newaxis]
+
+        corr = np.empty(len(n))
+        phase = np.empty(len(n))
+        norm2 = dataNorm2[windows]
+        for i in range(0, len(n), chunk):
+            part = slice(i, i + chunk)
+            corr[part], phase[part] = phaseFitMax(proj[part], gram[part],
+                                                  norm2[part], sinPow)
+
+        # Keep the best angle of every window
+        better = ~(corr <= corrMax[windows])
+        corrMax[windows] = np.where(better, corr, corrMax[windows])
+        thetaMax[windows] = np.where(better, theta, thetaMax[windows])
+        phaseMax[windows] = np.where(better, phase, phaseMax[windows])
+
+    return th0, corrMax, thetaMax, phaseMax
+
+
+def denseImage(denseMap, shape, subImgSize, stride):
+    """Image with the given shape where every value of a denseCorr map fills
+    the stride x stride square around the center of its window, nan
+    elsewhere."""
+
+    image = np.full(shape, np.nan)
+    big = np.repeat(np.repeat(denseMap, stride, 0), stride, 1)
+    offset = (int(subImgSize) - stride)//2
+    big = big[:shape[0] - offset, :shape[1] - offset]
+    image[offset:offset + big.shape[0], offset:offset + big.shape[1]] = big
+
+    return image
+
+
 def FFTMethod(data, thres=0.4):
     """A method for actin/spectrin ring finding. It performs FFT 2D analysis
     and looks for maxima at 180 nm in the frequency spectrum."""
@@ -6,10 +6,12 @@ Created on Fri Jul 29 19:27:26 2016
 """
 
 import os
-from tkinter import Tk, filedialog
 
 
+# tkinter is only imported by the file dialogs, so that the rest of the
+# module can be used without a display
 def getFilename(title, types, initialdir=None):
+    from tkinter import Tk, filedialog
     root = Tk()
     root.withdraw()
 #    filename = filedialog.askopenfilename(title=title, filetypes=types,
@@ -20,6 +22,7 @@ def getFilename(title, types, initialdir=None):
 
 
 def getFilenames(title, types=[], initialdir=None):
+    from tkinter import Tk, filedialog
     root = Tk()
     root.withdraw()
 #    filenames = filedialog.askopenfilenames(title=title, filetypes=types,